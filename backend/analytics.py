@@ -0,0 +1,302 @@
+"""Vectorized outage statistics over schedule history.
+
+Every channel is loaded into a cube of per-minute outage bitmaps shaped
+date x queue x 1440 (bit-packed along the minute axis). Aggregates are
+NumPy reductions over that cube. Cubes and query results are cached per
+data version, so repeated queries do not touch the files again.
+
+The fetcher rewrites every data file each cycle, so the multi-year history
+cube is keyed by the content of the history file and only rebuilt when a
+day actually changed; today and tomorrow are a small cube laid over it.
+Days folded into monthly aggregates by the history retention only count
+towards group_by=month.
+"""
+import hashlib
+import os
+import threading
+
+import numpy as np
+
+import history
+
+MINUTES_PER_DAY = 24 * 60
+GROUP_BY = ('day', 'week', 'month')
+BUILD_CHUNK_DAYS = 128
+MAX_CACHED_RESULTS = 1024
+CHANNEL_LOCKS = 16
+
+
+def period_bounds(period):
+    """(start, end) minutes of 'HH:MM-HH:MM' within one day; ends past midnight are clipped"""
+    try:
+        start, end = period.split('-')
+        sh, sm = map(int, start.split(':'))
+        eh, em = map(int, end.split(':'))
+    except ValueError:
+        return None
+    s = sh * 60 + sm
+    e = eh * 60 + em
+    if e <= s:
+        e = MINUTES_PER_DAY
+    return min(s, MINUTES_PER_DAY), min(e, MINUTES_PER_DAY)
+
+
+class ChannelCube:
+    """Outage bitmaps of one channel, one row per date sorted ascending"""
+
+    def __init__(self, entries=()):
+        by_date = {}
+        for entry in entries:
+            by_date[entry['schedule_date']] = entry.get('schedule', {})
+        dates = sorted(by_date)
+        self.queues = sorted({q for schedule in by_date.values() for q in schedule})
+        self.dates = np.array(dates, dtype='datetime64[D]')
+
+        qidx = {q: i for i, q in enumerate(self.queues)}
+        rows, cols, starts, ends = [], [], [], []
+        for d, date in enumerate(dates):
+            for queue, periods in by_date[date].items():
+                for period in periods:
+                    bounds = period_bounds(period)
+                    if bounds and bounds[0] < bounds[1]:
+                        rows.append(d)
+                        cols.append(qidx[queue])
+                        starts.append(bounds[0])
+                        ends.append(bounds[1])
+
+        rows = np.array(rows, dtype=np.intp)
+        cols = np.array(cols, dtype=np.intp)
+        starts = np.array(starts, dtype=np.intp)
+        ends = np.array(ends, dtype=np.intp)
+
+        self.bits = np.zeros((len(dates), len(self.queues), MINUTES_PER_DAY // 8), dtype=np.uint8)
+        self.minutes = np.zeros((len(dates), len(self.queues)), dtype=np.int32)
+        # Interval edges -> +1/-1 deltas -> running sum > 0 marks outage minutes,
+        # so overlapping periods are not counted twice. Built in chunks of days
+        # to keep the temporary arrays small for multi-year histories.
+        for lo in range(0, len(dates), BUILD_CHUNK_DAYS):
+            hi = min(lo + BUILD_CHUNK_DAYS, len(dates))
+            sel = (rows >= lo) & (rows < hi)
+            delta = np.zeros((hi - lo, len(self.queues), MINUTES_PER_DAY + 1), dtype=np.int16)
+            np.add.at(delta, (rows[sel] - lo, cols[sel], starts[sel]), 1)
+            np.add.at(delta, (rows[sel] - lo, cols[sel], ends[sel]), -1)
+            mask = np.cumsum(delta[..., :MINUTES_PER_DAY], axis=-1) > 0
+            self.bits[lo:hi] = np.packbits(mask, axis=-1)
+            self.minutes[lo:hi] = mask.sum(axis=-1, dtype=np.int32)
+
+    def overlay(self, other):
+        """New cube where the dates of `other` replace or extend this cube's"""
+        if not len(other.dates):
+            return self
+        queues = sorted(set(self.queues) | set(other.queues))
+        keep = ~np.isin(self.dates, other.dates)
+        dates = np.concatenate([self.dates[keep], other.dates])
+        order = np.argsort(dates, kind='stable')
+
+        def widen(cube, rows, values):
+            out = np.zeros((len(values) if rows is None else int(rows.sum()), len(queues)) + values.shape[2:],
+                           dtype=values.dtype)
+            out[:, [queues.index(q) for q in cube.queues]] = values if rows is None else values[rows]
+            return out
+
+        merged = ChannelCube()
+        merged.queues = queues
+        merged.dates = dates[order]
+        merged.bits = np.concatenate([widen(self, keep, self.bits), widen(other, None, other.bits)])[order]
+        merged.minutes = np.concatenate([widen(self, keep, self.minutes), widen(other, None, other.minutes)])[order]
+        return merged
+
+    def select(self, date_from, date_to):
+        lo = 0 if date_from is None else np.searchsorted(self.dates, np.datetime64(date_from, 'D'), 'left')
+        hi = len(self.dates) if date_to is None else np.searchsorted(self.dates, np.datetime64(date_to, 'D'), 'right')
+        return slice(lo, hi)
+
+    def aggregate(self, date_from, date_to, group_by, queue=None):
+        window = self.select(date_from, date_to)
+        dates = self.dates[window]
+        if queue is not None:
+            if queue not in self.queues:
+                return [], []
+            queues = [queue]
+            minutes = self.minutes[window][:, [self.queues.index(queue)]]
+        else:
+            queues = self.queues
+            minutes = self.minutes[window]
+        if not len(dates):
+            return queues, []
+
+        if group_by == 'month':
+            keys = dates.astype('datetime64[M]').astype('datetime64[D]')
+        elif group_by == 'week':
+            # 1970-01-01 was a Thursday: shift so that weeks start on Monday
+            keys = dates - ((dates.astype(np.int64) + 3) % 7).astype('timedelta64[D]')
+        else:
+            keys = dates
+
+        labels, first = np.unique(keys, return_index=True)
+        sums = np.add.reduceat(minutes, first, axis=0)
+        counts = np.diff(np.append(first, len(dates)))
+        periods = []
+        for label, count, row in zip(labels, counts, sums):
+            period = str(label)[:7] if group_by == 'month' else str(label)
+            periods.append({
+                'period': period,
+                'days': int(count),
+                'outage_hours': {q: round(int(m) / 60, 2) for q, m in zip(queues, row)},
+            })
+        return queues, periods
+
+
+def _content_hash(path):
+    digest = hashlib.sha1()
+    try:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+
+def month_aggregates(aggregates, date_from, date_to, queue):
+    """{month: (days, {queue: hours})} of folded months inside the query window"""
+    result = {}
+    for agg in aggregates:
+        month = agg.get('month', '')
+        if (date_from and month < date_from[:7]) or (date_to and month > date_to[:7]):
+            continue
+        hours = agg.get('outage_hours', {})
+        if queue is not None:
+            hours = {queue: hours[queue]} if queue in hours else {}
+        result[month] = (agg.get('days', 0), hours)
+    return result
+
+
+class OutageStats:
+    """Per-channel cubes and query results, rebuilt when the data files change"""
+
+    def __init__(self, base):
+        self.base = base
+        self._lock = threading.Lock()
+        self._channel_locks = [threading.Lock() for _ in range(CHANNEL_LOCKS)]
+        self._history = {}
+        self._cubes = {}
+        self._results = {}
+        self._results_version = None
+
+    def _paths(self, channel_id):
+        return [
+            os.path.join(self.base, f'schedule_history_{channel_id}.json'),
+            os.path.join(self.base, 'schedule_today.json'),
+            os.path.join(self.base, 'schedule_tomorrow.json'),
+        ]
+
+    def _channel_lock(self, channel_id):
+        # A fixed set of striped locks: bounded no matter which ids clients send
+        return self._channel_locks[hash(channel_id) % len(self._channel_locks)]
+
+    def _history_cube(self, channel_id):
+        """(cube, aggregates) of the history file, rebuilt only when its content changes"""
+        path = self._paths(channel_id)[0]
+        version = history.files_version([path])
+        cached = self._history.get(channel_id)
+        if cached and cached[0] == version:
+            return cached[2], cached[3]
+        digest = _content_hash(path)
+        if cached and cached[1] == digest:
+            # Rewritten with the same bytes, as most fetch cycles do
+            self._history[channel_id] = (version, digest, cached[2], cached[3])
+            return cached[2], cached[3]
+        entries, aggregates = history.load(path)
+        cube = ChannelCube(entries)
+        self._history[channel_id] = (version, digest, cube, aggregates)
+        return cube, aggregates
+
+    def _day_entries(self, channel_id):
+        entries = []
+        for path in self._paths(channel_id)[1:]:
+            doc = history.read_document(path)
+            if isinstance(doc, list):
+                entries.extend(item for item in doc
+                               if item.get('channel_id') == channel_id and item.get('schedule_date'))
+        return entries
+
+    def cube(self, channel_id):
+        """(cube, aggregates): history with today and tomorrow laid over it"""
+        version = history.files_version(self._paths(channel_id))
+        cached = self._cubes.get(channel_id)
+        if cached and cached[0] == version:
+            return cached[1], cached[2]
+        # Builds of one channel never hold up queries of another
+        with self._channel_lock(channel_id):
+            cached = self._cubes.get(channel_id)
+            if cached and cached[0] == version:
+                return cached[1], cached[2]
+            history_cube, aggregates = self._history_cube(channel_id)
+            cube = history_cube.overlay(ChannelCube(self._day_entries(channel_id)))
+            if version[0][1] is None:
+                # No history file: an unknown channel id must not grow the caches
+                self._history.pop(channel_id, None)
+                return cube, aggregates
+            self._cubes[channel_id] = (version, cube, aggregates)
+            return cube, aggregates
+
+    def channel_ids(self):
+        doc = history.read_document(os.path.join(self.base, 'cities.json')) or {}
+        return [(city['id'], city.get('name')) for city in doc.get('cities', [])]
+
+    def query(self, channel_id=None, queue=None, date_from=None, date_to=None, group_by='day'):
+        cities = self.channel_ids()
+        if channel_id is not None:
+            cities = [c for c in cities if c[0] == channel_id] or [(channel_id, None)]
+        paths = [p for cid, _name in cities for p in self._paths(cid)]
+        paths.append(os.path.join(self.base, 'cities.json'))
+        version = history.files_version(paths)
+        key = (channel_id, queue, date_from, date_to, group_by)
+
+        with self._lock:
+            if self._results_version != version:
+                self._results = {}
+                self._results_version = version
+            if key in self._results:
+                return self._results[key]
+
+        channels = []
+        for cid, name in cities:
+            cube, aggregates = self.cube(cid)
+            queues, periods = cube.aggregate(date_from, date_to, group_by, queue)
+            if group_by == 'month' and aggregates:
+                periods = self._with_folded_months(periods, month_aggregates(aggregates, date_from, date_to, queue))
+                queues = sorted(set(queues).union(*(p['outage_hours'] for p in periods)))
+            totals = {q: round(sum(p['outage_hours'].get(q, 0) for p in periods), 2) for q in queues}
+            channels.append({
+                'channel_id': cid,
+                'city_name': name or 'Невідоме місто',
+                'days': sum(p['days'] for p in periods),
+                'total_outage_hours': totals,
+                'periods': periods,
+            })
+        result = {
+            'group_by': group_by,
+            'from': date_from,
+            'to': date_to,
+            'queue': queue,
+            'channels': channels,
+        }
+        with self._lock:
+            if self._results_version == version:
+                if len(self._results) >= MAX_CACHED_RESULTS:
+                    self._results.clear()
+                self._results[key] = result
+        return result
+
+    @staticmethod
+    def _with_folded_months(periods, folded):
+        """Add months kept only as retention aggregates to per-month periods"""
+        by_month = {p['period']: p for p in periods}
+        for month, (days, hours) in folded.items():
+            period = by_month.setdefault(month, {'period': month, 'days': 0, 'outage_hours': {}})
+            period['days'] += days
+            for q, h in hours.items():
+                period['outage_hours'][q] = round(period['outage_hours'].get(q, 0) + h, 2)
+        return [by_month[m] for m in sorted(by_month)]
@@ -1,14 +1,61 @@
-from flask import Flask, jsonify, render_template, request
+from flask import Flask, Response, g, jsonify, render_template, request
 import json
 import os
 import subprocess
 import sys
+import threading
 import time
+import urllib.parse
+import uuid
 from apscheduler.schedulers.background import BackgroundScheduler
 from datetime import datetime
 
+import analytics
+import history
+import ical
+import metrics
+import profiling
+import store
+import throttle
+import webhooks
+
 app = Flask(__name__, template_folder='templates', static_folder='static')
 
+config_path = os.path.join(os.path.dirname(__file__), 'config.json')
+cfg = {}
+if os.path.exists(config_path):
+    with open(config_path, 'r', encoding='utf-8') as f:
+        cfg = json.load(f)
+
+profile_settings = profiling.load_settings(cfg, os.path.dirname(__file__))
+history_settings = history.load_settings(cfg)
+# Response bodies come from the same builders as the ASGI server and the static export
+schedule_store = store.ScheduleStore(os.path.dirname(__file__), use_archive=history_settings['archive'])
+rate_limit_settings = throttle.load_settings(cfg)
+request_limiter = throttle.TokenBucketLimiter(rate_limit_settings['rate'], rate_limit_settings['burst'],
+                                              rate_limit_settings['max_clients'])
+update_limiter = throttle.TokenBucketLimiter(rate_limit_settings['update_per_minute'] / 60,
+                                             rate_limit_settings['update_burst'], rate_limit_settings['max_clients'])
+single_flight = throttle.SingleFlight()
+outage_stats = analytics.OutageStats(os.path.dirname(__file__))
+calendar_settings = ical.load_settings(cfg)
+calendar_feeds = ical.CalendarFeeds(os.path.dirname(__file__), cfg.get('timezone_offset', 2), calendar_settings)
+webhook_settings = webhooks.load_settings(cfg)
+webhook_dispatcher = webhooks.WebhookDispatcher(os.path.dirname(__file__), webhook_settings)
+webhook_dispatcher.start()
+request_profiler = None
+if profile_settings['enabled']:
+    request_profiler = profiling.RequestProfiler(profile_settings)
+    request_profiler.install(app)
+
+registry = metrics.Registry()
+registry.describe('api_requests_total', 'HTTP requests served by the API')
+registry.describe('api_request_duration_seconds', 'HTTP request latency')
+registry.describe('updater_runs_total', 'Parser subprocess runs by result')
+registry.describe('api_rate_limited_total', 'Requests rejected with 429 by the per-client rate limiter')
+registry.describe('api_coalesced_requests_total', 'Requests answered from a concurrent identical request')
+registry.describe('updater_duration_seconds', 'Wall time of a parser subprocess run')
+
 
 last_update = {
     'timestamp': None,
@@ -16,6 +63,7 @@ last_update = {
     'message': 'Чекання першого оновлення...'
 }
 update_in_progress = False
+webhooks_lock = threading.Lock()
 
 
 def update_data_task():
@@ -27,6 +75,7 @@ def update_data_task():
         return
     
     update_in_progress = True
+    started = time.perf_counter()
     try:
         base = os.path.dirname(__file__)
         fetcher = os.path.join(base, 'fetcher.py')
@@ -41,6 +90,7 @@ def update_data_task():
                 'message': 'Дані оновлено успішно!'
             }
             print("✓ Дані оновлено успішно!")
+            webhook_dispatcher.poll_outbox()
         else:
             last_update = {
                 'timestamp': datetime.now().isoformat(),
@@ -63,6 +113,8 @@ def update_data_task():
         }
         print(f"✗ Помилка: {str(e)}")
     finally:
+        registry.observe('updater_duration_seconds', time.perf_counter() - started)
+        registry.inc('updater_runs_total', result=last_update['status'])
         update_in_progress = False
 
 
@@ -76,6 +128,64 @@ print("API стартує... Запуск першого оновлення да
 update_data_task()
 
 
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+@app.before_request
+def enforce_rate_limit():
+    if not rate_limit_settings['enabled'] or not request.path.startswith('/api/'):
+        return None
+    client = throttle.client_address(request.remote_addr, request.headers.get('X-Forwarded-For'),
+                                     rate_limit_settings['trusted_proxies'])
+    wait = request_limiter.acquire(client)
+    if not wait and request.path == '/api/update':
+        wait = update_limiter.acquire(client)
+    if not wait:
+        return None
+    endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+    registry.inc('api_rate_limited_total', endpoint=endpoint)
+    response = jsonify({"error": "Забагато запитів, спробуйте пізніше"})
+    response.status_code = 429
+    response.headers['Retry-After'] = throttle.retry_after_header(wait)
+    return response
+
+
+@app.before_request
+def require_webhook_token():
+    if not request.path.startswith('/api/webhooks'):
+        return None
+    if not webhook_settings['admin_token']:
+        return jsonify({"error": "Керування вебхуками вимкнене: не задано webhooks.admin_token"}), 403
+    if not webhooks.authorized(webhook_settings, request.headers.get('Authorization')):
+        response = jsonify({"error": "Потрібен заголовок Authorization: Bearer <admin_token>"})
+        response.status_code = 401
+        response.headers['WWW-Authenticate'] = 'Bearer'
+        return response
+    return None
+
+
+def coalesced(key, compute):
+    """Відповідь з (body, status), однакові одночасні запити рахуються один раз"""
+    (body, status), shared = single_flight.do(key, compute)
+    if shared:
+        registry.inc('api_coalesced_requests_total', endpoint=key[0])
+    return jsonify(body), status
+
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        registry.observe('api_request_duration_seconds', time.perf_counter() - started,
+                         endpoint=endpoint, method=request.method)
+        registry.inc('api_requests_total', endpoint=endpoint, method=request.method,
+                     status=response.status_code)
+    return response
+
+
 @app.route('/', methods=['GET'])
 def index():
     return render_template('index.html')
@@ -101,11 +211,27 @@ def get_status():
     GET /api/status
     Повертає статус останнього оновлення даних парсером
     """
-    return jsonify({
+    status = {
         'last_update': last_update,
         'parsing_in_progress': update_in_progress,
         'auto_update_interval_minutes': 15
-    })
+    }
+    if request_profiler is not None:
+        status['profiling'] = {
+            'fetch': profiling.load_summary(profile_settings, 'fetch'),
+            'requests': request_profiler.summary()
+        }
+    return jsonify(status)
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    GET /metrics
+    Метрики API та парсера у текстовому форматі Prometheus
+    """
+    fetch_registry = metrics.Registry()
+    fetch_registry.load(os.path.join(os.path.dirname(__file__), 'fetch_metrics.json'))
+    return Response(metrics.render_all(registry, fetch_registry), mimetype='text/plain; version=0.0.4')
 
 @app.route('/api/update', methods=['POST'])
 def trigger_update():
@@ -149,61 +275,8 @@ def get_schedules():
     if not channel_id or not date:
         return jsonify({"error": "channel_id та date параметри обов'язкові"}), 400
     
-    base = os.path.dirname(__file__)
-    
-    history_file = os.path.join(base, f'schedule_history_{channel_id}.json')
-    schedule_data = None
-    schedule_time = None
-    emergency_outages = False
-    
-    if os.path.exists(history_file):
-        try:
-            with open(history_file, 'r', encoding='utf-8') as f:
-                history = json.load(f)
-                for item in history:
-                    if item.get('schedule_date') == date:
-                        schedule_data = item.get('schedule', {})
-                        schedule_time = item.get('schedule_time', '')
-                        emergency_outages = item.get('emergency_outages', False)
-                        break
-        except json.JSONDecodeError:
-            pass
-    
-    if not schedule_data:
-        return jsonify({"error": f"Розклад на {date} не знайдено"}), 404
-    
-    if queue:
-        if queue in schedule_data:
-            filtered_schedule = {queue: schedule_data[queue]}
-        else:
-            return jsonify({"error": f"Черга {queue} не знайдена"}), 404
-    else:
-        filtered_schedule = schedule_data
-    
-
-    cities_file = os.path.join(base, 'cities.json')
-    city_name = None
-    if os.path.exists(cities_file):
-        try:
-            with open(cities_file, 'r', encoding='utf-8') as f:
-                cities_data = json.load(f)
-                for city in cities_data.get('cities', []):
-                    if city['id'] == channel_id:
-                        city_name = city['name']
-                        break
-        except json.JSONDecodeError:
-            pass
-    
-    response = {
-        "channel_id": channel_id,
-        "city_name": city_name or "Невідоме місто",
-        "date": date,
-        "time": schedule_time,
-        "schedule": filtered_schedule,
-        "emergency_outages": emergency_outages
-    }
-    
-    return jsonify(response)
+    return coalesced(('schedules', channel_id, date, queue),
+                     lambda: store.history_response(schedule_store, channel_id, date, queue))
 
 
 @app.route('/api/schedules/today', methods=['GET'])
@@ -220,64 +293,8 @@ def get_schedules_today():
     if not channel_id:
         return jsonify({"error": "channel_id параметр обов'язковий"}), 400
     
-    base = os.path.dirname(__file__)
-    today_file = os.path.join(base, 'schedule_today.json')
-    
-    schedule_data = None
-    schedule_time = None
-    schedule_date = None
-    emergency_outages = False
-    
-    if os.path.exists(today_file):
-        try:
-            with open(today_file, 'r', encoding='utf-8') as f:
-                today_data = json.load(f)
-                if isinstance(today_data, list):
-                    for item in today_data:
-                        if item.get('channel_id') == channel_id:
-                            schedule_date = item.get('schedule_date', datetime.datetime.now().strftime("%Y-%m-%d"))
-                            schedule_data = item.get('schedule', {})
-                            schedule_time = item.get('schedule_time', '')
-                            emergency_outages = item.get('emergency_outages', False)
-                            break
-        except json.JSONDecodeError:
-            pass
-    
-    if not schedule_data:
-        return jsonify({"error": "Розклад на сьогодні не знайдено"}), 404
-    
-    if queue:
-        if queue in schedule_data:
-            filtered_schedule = {queue: schedule_data[queue]}
-        else:
-            return jsonify({"error": f"Черга {queue} не знайдена"}), 404
-    else:
-        filtered_schedule = schedule_data
-
-    cities_file = os.path.join(base, 'cities.json')
-    city_name = None
-    if os.path.exists(cities_file):
-        try:
-            with open(cities_file, 'r', encoding='utf-8') as f:
-                cities_data = json.load(f)
-                for city in cities_data.get('cities', []):
-                    if city['id'] == channel_id:
-                        city_name = city['name']
-                        break
-        except json.JSONDecodeError:
-            pass
-    
-    response = {
-        "channel_id": channel_id,
-        "city_name": city_name or "Невідоме місто",
-        "date": schedule_date,
-        "time": schedule_time,
-        "schedule": filtered_schedule,
-        "emergency_outages": emergency_outages
-    }
-    
-    return jsonify(response)
-
+    return coalesced(('today', channel_id, queue),
+                     lambda: store.day_response(schedule_store, 'today', channel_id, queue))
 
 
 @app.route('/api/schedules/tomorrow', methods=['GET'])
@@ -294,68 +311,135 @@ def get_schedules_tomorrow():
     if not channel_id:
         return jsonify({"error": "channel_id параметр обов'язковий"}), 400
     
+    return coalesced(('tomorrow', channel_id, queue),
+                     lambda: store.day_response(schedule_store, 'tomorrow', channel_id, queue))
+
+
+@app.route('/api/stats', methods=['GET'])
+def get_stats():
+    """
+    GET /api/stats
+    Години відключень по чергах за день/тиждень/місяць
+    Параметри:
+      - channel_id: ID каналу/міста (опціональний, без нього - порівняння всіх міст)
+      - queue: номер черги (опціональний)
+      - from, to: межі періоду YYYY-MM-DD (опціональні)
+      - group_by: day, week або month (за замовчуванням day)
+    """
+    channel_id = request.args.get('channel_id', type=int)
+    queue = request.args.get('queue') or None
+    date_from = request.args.get('from') or None
+    date_to = request.args.get('to') or None
+    group_by = request.args.get('group_by', 'day')
+
+    if group_by not in analytics.GROUP_BY:
+        return jsonify({"error": "group_by має бути day, week або month"}), 400
+    try:
+        date_from = datetime.strptime(date_from, "%Y-%m-%d").date().isoformat() if date_from else None
+        date_to = datetime.strptime(date_to, "%Y-%m-%d").date().isoformat() if date_to else None
+    except ValueError:
+        return jsonify({"error": "Невірна дата, формат: YYYY-MM-DD"}), 400
+
+    return jsonify(outage_stats.query(channel_id, queue, date_from, date_to, group_by))
+
+
+@app.route('/api/calendar/<int:channel_id>/<queue>.ics', methods=['GET'])
+def get_calendar(channel_id, queue):
+    """
+    GET /api/calendar/<channel_id>/<queue>.ics
+    Календар iCalendar з відключеннями черги (недавня історія, сьогодні, завтра)
+    """
+    feed = calendar_feeds.feed(channel_id, queue)
+    if feed is None:
+        return jsonify({"error": f"Черга {queue} не знайдена"}), 404
+    body, etag = feed
+
+    response = Response(body, mimetype='text/calendar')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = calendar_settings['max_age']
+    return response.make_conditional(request)
+
+@app.route('/api/webhooks', methods=['GET'])
+def list_webhooks():
+    """
+    GET /api/webhooks
+    Список підписок на зміни графіків та статистика доставки
+    """
+    return jsonify({
+        'subscriptions': webhooks.load_subscriptions(os.path.dirname(__file__)),
+        'delivery': dict(webhook_dispatcher.stats, pending=webhook_dispatcher.pending())
+    })
+
+@app.route('/api/webhooks', methods=['POST'])
+def create_webhook():
+    """
+    POST /api/webhooks
+    Тіло JSON:
+      - url: адреса отримувача http(s) (обовязковий)
+      - channel_id: ID каналу/міста (опціональний, без нього - всі канали)
+      - queue: номер черги (опціональний, без нього - всі черги)
+    """
+    data = request.get_json(silent=True) or {}
+    url = data.get('url')
+    channel_id = data.get('channel_id')
+    queue = data.get('queue')
+
+    if not url or urllib.parse.urlsplit(url).scheme not in ('http', 'https'):
+        return jsonify({"error": "url параметр обов'язковий (http або https)"}), 400
+    try:
+        webhooks.check_target(url, webhook_settings)
+    except ValueError as e:
+        return jsonify({"error": f"Недозволена адреса отримувача: {e}"}), 400
+    if channel_id is not None and not isinstance(channel_id, int):
+        return jsonify({"error": "channel_id має бути числом"}), 400
+    if queue is not None:
+        queue = str(queue)
+
     base = os.path.dirname(__file__)
-    tomorrow_file = os.path.join(base, 'schedule_tomorrow.json')
-    
-    schedule_data = None
-    schedule_time = None
-    schedule_date = None
-    emergency_outages = False
-    
-    if os.path.exists(tomorrow_file):
-        try:
-            with open(tomorrow_file, 'r', encoding='utf-8') as f:
-                tomorrow_data = json.load(f)
-                if isinstance(tomorrow_data, list):
-                    for item in tomorrow_data:
-                        if item.get('channel_id') == channel_id:
-                            schedule_date = item.get('schedule_date', (datetime.datetime.now() + datetime.timedelta(days=1)).strftime("%Y-%m-%d"))
-                            schedule_data = item.get('schedule', {})
-                            schedule_time = item.get('schedule_time', '')
-                            emergency_outages = item.get('emergency_outages', False)
-                            break
-        except json.JSONDecodeError:
-            pass
-    
-    if not schedule_data:
-        return jsonify({"error": "Розклад на завтра не знайдено"}), 404
-    
-    if queue:
-        if queue in schedule_data:
-            filtered_schedule = {queue: schedule_data[queue]}
-        else:
-            return jsonify({"error": f"Черга {queue} не знайдена"}), 404
-    else:
-        filtered_schedule = schedule_data
-    
-    cities_file = os.path.join(base, 'cities.json')
-    city_name = None
-    if os.path.exists(cities_file):
-        try:
-            with open(cities_file, 'r', encoding='utf-8') as f:
-                cities_data = json.load(f)
-                for city in cities_data.get('cities', []):
-                    if city['id'] == channel_id:
-                        city_name = city['name']
-                        break
-        except json.JSONDecodeError:
-            pass
-    
-    response = {
-        "channel_id": channel_id,
-        "city_name": city_name or "Невідоме місто",
-        "date": schedule_date,
-        "time": schedule_time,
-        "schedule": filtered_schedule,
-        "emergency_outages": emergency_outages
+    subscription = {
+        'id': uuid.uuid4().hex,
+        'url': url,
+        'channel_id': channel_id,
+        'queue': queue,
+        'created': datetime.now().isoformat()
     }
-    
-    return jsonify(response)
+    with webhooks_lock:
+        subs = webhooks.load_subscriptions(base)
+        if len(subs) >= webhook_settings['max_subscriptions']:
+            return jsonify({"error": f"Досягнуто ліміту підписок ({webhook_settings['max_subscriptions']})"}), 409
+        subs.append(subscription)
+        webhooks.save_subscriptions(base, subs)
+    return jsonify(subscription), 201
+
+@app.route('/api/webhooks/<subscription_id>', methods=['DELETE'])
+def delete_webhook(subscription_id):
+    """
+    DELETE /api/webhooks/<id>
+    Видалення підписки
+    """
+    base = os.path.dirname(__file__)
+    with webhooks_lock:
+        subs = webhooks.load_subscriptions(base)
+        remaining = [s for s in subs if s.get('id') != subscription_id]
+        if len(remaining) == len(subs):
+            return jsonify({"error": f"Підписка {subscription_id} не знайдена"}), 404
+        webhooks.save_subscriptions(base, remaining)
+    return jsonify({'status': 'deleted', 'id': subscription_id})
+
+@app.route('/api/webhooks/dead-letter', methods=['GET'])
+def get_webhook_dead_letters():
+    """
+    GET /api/webhooks/dead-letter
+    Доставки, які не вдалися після всіх повторних спроб
+    """
+    return jsonify({'dead_letters': webhooks.load_dead_letters(os.path.dirname(__file__))})
 
 
 import atexit
 
 atexit.register(lambda: scheduler.shutdown())
+atexit.register(webhook_dispatcher.stop)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,380 @@
+"""Memory-mapped binary archive of a channel's schedule history.
+
+schedule_history_{id}.gpva holds one fixed-size record per day behind a
+sorted date index, so a lookup is a binary search over the mapped file
+and decodes only the requested day. Every process maps the same file, so
+API workers share its pages through the OS cache instead of each keeping
+decoded JSON in memory.
+
+Layout (little-endian):
+
+    header     magic 'GPVA', version, queue count, record count, channel id,
+               labels size, overflow offset, overflow size
+    labels     queue labels, UTF-8, newline separated
+    index      record count x int32 proleptic ordinals of the dates, ascending
+    records    record count x (flags u8, 3 pad bytes, schedule_time seconds i32,
+               queue presence mask u64, queue count x 6-byte slot bitmaps)
+    overflow   JSON with the monthly aggregates and, for the few days that do
+               not render back from the record exactly, the verbatim periods
+               of queues off the half-hour grid (overlaps, '24:00', periods
+               past midnight) and other fields to set or remove
+
+Schedules are published on a half-hour grid, so a day is 48 slots of 30
+minutes and a queue costs 6 bytes per day. Bitmaps use numpy.packbits bit
+order: slot n (minutes 30n..30n+29) is bit 7 - n % 8 of byte n // 8.
+
+Usage:
+    python archive.py build [--channel ID]
+    python archive.py export FILE.gpva [--output FILE.json]
+"""
+import argparse
+import bisect
+import collections
+import datetime
+import glob
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+
+import history
+
+MAGIC = b'GPVA'
+VERSION = 2
+MINUTES = 24 * 60
+SLOT_MINUTES = 30
+SLOTS = MINUTES // SLOT_MINUTES
+BITMAP_SIZE = SLOTS // 8
+MAX_QUEUES = 64
+
+HEADER = struct.Struct('<4sHHIiIII')
+RECORD_HEADER = struct.Struct('<B3xiQ')
+
+FLAG_EMERGENCY = 1
+FLAG_HAS_TIME = 2
+FLAG_OVERFLOW = 4
+
+STANDARD_KEYS = ('channel_id', 'schedule_date', 'schedule_time', 'schedule', 'emergency_outages')
+_RUNS = re.compile('1+')
+
+
+def archive_path(history_path):
+    """schedule_history_{id}.json -> schedule_history_{id}.gpva"""
+    return os.path.splitext(history_path)[0] + '.gpva'
+
+
+def _align(offset):
+    return (offset + 7) & ~7
+
+
+def _period_minutes(period):
+    try:
+        start, end = period.split('-')
+        sh, sm = map(int, start.split(':'))
+        eh, em = map(int, end.split(':'))
+    except (ValueError, AttributeError):
+        return None
+    s = sh * 60 + sm
+    e = eh * 60 + em
+    if e <= s:
+        e += MINUTES
+    return max(0, min(s, MINUTES)), max(0, min(e, MINUTES))
+
+
+def encode_periods(periods):
+    """Slot bitmap of periods; off-grid bounds widen to whole slots (the caller keeps those exactly)"""
+    mask = 0
+    for period in periods:
+        bounds = _period_minutes(period)
+        if bounds and bounds[1] > bounds[0]:
+            s = bounds[0] // SLOT_MINUTES
+            e = -(-bounds[1] // SLOT_MINUTES)
+            mask |= ((1 << (e - s)) - 1) << (SLOTS - e)
+    return mask.to_bytes(BITMAP_SIZE, 'big')
+
+
+def decode_periods(bitmap):
+    bits = format(int.from_bytes(bitmap, 'big'), f'0{SLOTS}b')
+    periods = []
+    for run in _RUNS.finditer(bits):
+        s = run.start() * SLOT_MINUTES
+        e = run.end() * SLOT_MINUTES % MINUTES
+        periods.append(f"{s // 60:02d}:{s % 60:02d}-{e // 60:02d}:{e % 60:02d}")
+    return periods
+
+
+def _time_seconds(value):
+    try:
+        t = datetime.time.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    if t.microsecond or t.tzinfo or t.strftime('%H:%M:%S') != value:
+        return None
+    return t.hour * 3600 + t.minute * 60 + t.second
+
+
+def _format_seconds(seconds):
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def _decode_record(buf, offset, labels, channel_id, date):
+    flags, seconds, mask = RECORD_HEADER.unpack_from(buf, offset)
+    schedule = {}
+    pos = offset + RECORD_HEADER.size
+    for i, label in enumerate(labels):
+        if mask >> i & 1:
+            schedule[label] = decode_periods(buf[pos:pos + BITMAP_SIZE])
+        pos += BITMAP_SIZE
+    return flags, {
+        'channel_id': channel_id,
+        'schedule_date': date,
+        'schedule_time': _format_seconds(seconds) if flags & FLAG_HAS_TIME else '',
+        'schedule': schedule,
+        'emergency_outages': bool(flags & FLAG_EMERGENCY),
+    }
+
+
+def encode(entries, aggregates, channel_id):
+    """Archive bytes of day entries; the first entry of a duplicated date wins"""
+    channel_id = channel_id or 0
+    by_date = {}
+    for entry in entries:
+        date = entry.get('schedule_date')
+        try:
+            ordinal = datetime.date.fromisoformat(date).toordinal()
+        except (TypeError, ValueError):
+            continue
+        by_date.setdefault(ordinal, entry)
+    ordinals = sorted(by_date)
+
+    labels = sorted({q for entry in by_date.values() for q in (entry.get('schedule') or {})})
+    if len(labels) > MAX_QUEUES:
+        raise ValueError(f'Too many queues for the archive: {len(labels)} > {MAX_QUEUES}')
+    labels_blob = '\n'.join(labels).encode('utf-8')
+
+    record_size = RECORD_HEADER.size + len(labels) * BITMAP_SIZE
+    index_offset = _align(HEADER.size + len(labels_blob))
+    records_offset = _align(index_offset + 4 * len(ordinals))
+    overflow_offset = records_offset + record_size * len(ordinals)
+
+    buf = bytearray(overflow_offset)
+    overflow_days = {}
+    for n, ordinal in enumerate(ordinals):
+        entry = by_date[ordinal]
+        date = entry['schedule_date']
+        schedule = entry.get('schedule') or {}
+        seconds = _time_seconds(entry.get('schedule_time', ''))
+        flags = FLAG_EMERGENCY if entry.get('emergency_outages') else 0
+        if seconds is not None:
+            flags |= FLAG_HAS_TIME
+        mask = 0
+        offset = records_offset + n * record_size
+        queues = {}
+        for i, label in enumerate(labels):
+            if label in schedule:
+                mask |= 1 << i
+                pos = offset + RECORD_HEADER.size + i * BITMAP_SIZE
+                buf[pos:pos + BITMAP_SIZE] = encode_periods(schedule[label])
+                # Only the queues that do not render back exactly are kept verbatim
+                if decode_periods(buf[pos:pos + BITMAP_SIZE]) != schedule[label]:
+                    queues[label] = schedule[label]
+        RECORD_HEADER.pack_into(buf, offset, flags, seconds or 0, mask)
+        struct.pack_into('<i', buf, index_offset + 4 * n, ordinal)
+
+        # Keep whatever the fixed record cannot reproduce exactly
+        _flags, decoded = _decode_record(buf, offset, labels, channel_id, date)
+        decoded['schedule'].update(queues)
+        changed = {k: v for k, v in entry.items() if k not in decoded or decoded[k] != v}
+        missing = [k for k in STANDARD_KEYS if k not in entry]
+        if queues or changed or missing:
+            overflow_days[date] = {'queues': queues, 'set': changed, 'unset': missing}
+            RECORD_HEADER.pack_into(buf, offset, flags | FLAG_OVERFLOW, seconds or 0, mask)
+
+    overflow = json.dumps({'aggregates': aggregates or [], 'days': overflow_days},
+                          ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    HEADER.pack_into(buf, 0, MAGIC, VERSION, len(labels), len(ordinals), channel_id,
+                     len(labels_blob), overflow_offset, len(overflow))
+    buf[HEADER.size:HEADER.size + len(labels_blob)] = labels_blob
+    return bytes(buf) + overflow
+
+
+def write(path, entries, aggregates, channel_id):
+    """Atomically write an archive file"""
+    data = encode(entries, aggregates, channel_id)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+    return len(data)
+
+
+def build_from_history(history_path, channel_id):
+    """Rewrite the archive next to a JSON history file from its current content"""
+    entries, aggregates = history.load(history_path)
+    return write(archive_path(history_path), entries, aggregates, channel_id)
+
+
+class Archive:
+    """Read-only view of an archive file through mmap"""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, queue_count, self.count, self.channel_id,
+         labels_size, self._overflow_offset, self._overflow_size) = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f'{path} is not a version {VERSION} schedule archive')
+        self.labels = self._mm[HEADER.size:HEADER.size + labels_size].decode('utf-8').split('\n') \
+            if queue_count else []
+        self._record_size = RECORD_HEADER.size + queue_count * BITMAP_SIZE
+        index_offset = _align(HEADER.size + labels_size)
+        self._records_offset = _align(index_offset + 4 * self.count)
+        view = memoryview(self._mm)[index_offset:index_offset + 4 * self.count]
+        # Zero-copy index on little-endian hosts
+        self._index = view.cast('i') if sys.byteorder == 'little' and struct.calcsize('i') == 4 else \
+            [v for (v,) in struct.iter_unpack('<i', view)]
+        self._overflow = None
+        self._lock = threading.Lock()
+
+    def _overflow_doc(self):
+        if self._overflow is None:
+            with self._lock:
+                if self._overflow is None:
+                    start = self._overflow_offset
+                    self._overflow = json.loads(self._mm[start:start + self._overflow_size].decode('utf-8'))
+        return self._overflow
+
+    def _entry(self, n):
+        date = datetime.date.fromordinal(self._index[n]).isoformat()
+        flags, entry = _decode_record(self._mm, self._records_offset + n * self._record_size,
+                                      self.labels, self.channel_id, date)
+        if flags & FLAG_OVERFLOW:
+            overrides = self._overflow_doc()['days'].get(date, {})
+            entry['schedule'].update(overrides.get('queues', {}))
+            entry.update(overrides.get('set', {}))
+            for key in overrides.get('unset', []):
+                entry.pop(key, None)
+        return entry
+
+    def _position(self, date):
+        try:
+            ordinal = datetime.date.fromisoformat(date).toordinal()
+        except (TypeError, ValueError):
+            return None
+        n = bisect.bisect_left(self._index, ordinal)
+        if n < self.count and self._index[n] == ordinal:
+            return n
+        return None
+
+    def find_day(self, date):
+        """Day entry for `date`, or None"""
+        n = self._position(date)
+        return None if n is None else self._entry(n)
+
+    def bitmap(self, date, queue):
+        """Zero-copy 6-byte half-hour slot bitmap of a queue on `date`, or None"""
+        n = self._position(date)
+        if n is None or queue not in self.labels:
+            return None
+        offset = self._records_offset + n * self._record_size
+        i = self.labels.index(queue)
+        if not RECORD_HEADER.unpack_from(self._mm, offset)[2] >> i & 1:
+            return None
+        pos = offset + RECORD_HEADER.size + i * BITMAP_SIZE
+        return memoryview(self._mm)[pos:pos + BITMAP_SIZE]
+
+    def dates(self):
+        return [datetime.date.fromordinal(o).isoformat() for o in self._index]
+
+    def entries(self):
+        """All day entries, newest first like the JSON history"""
+        return [self._entry(n) for n in range(self.count - 1, -1, -1)]
+
+    def aggregates(self):
+        return self._overflow_doc().get('aggregates', [])
+
+
+def open_archive(path):
+    """Archive at `path`, or None when there is no readable archive file"""
+    try:
+        return Archive(path)
+    except (OSError, ValueError, struct.error) as e:
+        if not isinstance(e, FileNotFoundError):
+            print(f'Cannot open archive {path}: {e}')
+        return None
+
+
+class Archives:
+    """Open archives per channel, reopened when the file is replaced.
+
+    At most `max_open` channels stay mapped; the least recently used one is
+    dropped first, so unknown channel ids cannot grow the cache.
+    """
+
+    def __init__(self, base, max_open=256):
+        self.base = base
+        self.max_open = max_open
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, channel_id):
+        """Archive of a channel, or None when there is no readable archive file"""
+        path = os.path.join(self.base, f'schedule_history_{channel_id}.gpva')
+        version = history.files_version([path])
+        with self._lock:
+            cached = self._cache.get(channel_id)
+            if cached and cached[0] == version:
+                self._cache.move_to_end(channel_id)
+                return cached[1]
+        value = open_archive(path)
+        with self._lock:
+            # The old mapping is released once in-flight readers drop it
+            self._cache[channel_id] = (version, value)
+            self._cache.move_to_end(channel_id)
+            while len(self._cache) > self.max_open:
+                self._cache.popitem(last=False)
+        return value
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Binary schedule history archive')
+    sub = parser.add_subparsers(dest='command', required=True)
+    build = sub.add_parser('build', help='convert schedule_history_*.json into .gpva archives')
+    build.add_argument('--channel', type=int, help='only this channel id')
+    export = sub.add_parser('export', help='convert an archive back into the JSON history layout')
+    export.add_argument('archive')
+    export.add_argument('--output', help='JSON path (default: next to the archive)')
+    args = parser.parse_args(argv)
+
+    base = os.path.dirname(os.path.abspath(__file__))
+    if args.command == 'build':
+        for path in sorted(glob.glob(os.path.join(base, 'schedule_history_*.json'))):
+            try:
+                channel_id = int(os.path.basename(path)[len('schedule_history_'):-len('.json')])
+            except ValueError:
+                continue
+            if args.channel is not None and channel_id != args.channel:
+                continue
+            size = build_from_history(path, channel_id)
+            entries, _aggregates = history.load(path)
+            first = {}
+            for entry in entries:
+                first.setdefault(entry.get('schedule_date'), entry)
+            restored = Archive(archive_path(path))
+            lossless = all(restored.find_day(date) == entry for date, entry in first.items())
+            print(f'{os.path.basename(path)}: {os.path.getsize(path)} -> {size} bytes, '
+                  f'{restored.count} days, {"lossless" if lossless else "NOT lossless"}')
+    else:
+        restored = Archive(args.archive)
+        output = args.output or os.path.splitext(args.archive)[0] + '.json'
+        cfg = history.read_document(os.path.join(base, 'config.json')) or {}
+        kept = history.save(output, restored.entries(), restored.aggregates(), restored.channel_id,
+                            history.load_settings(cfg), str(datetime.date.today()))
+        print(f'{output}: {len(kept)} days written')
+
+
+if __name__ == '__main__':
+    main()
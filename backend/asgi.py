@@ -0,0 +1,247 @@
+"""ASGI serving mode for the schedule API.
+
+Serves the same routes and JSON bodies as app.py from a shared in-memory
+ScheduleStore, and runs the fetch scheduler as a task on the server's
+event loop instead of a BackgroundScheduler thread. Handlers never read
+files on the loop: the store serves the previous value while a changed
+file reloads in a thread, and first loads are awaited via to_thread.
+Webhook deliveries run on the dispatcher's own threads, as in app.py.
+
+Run:
+    uvicorn asgi:app --app-dir backend --host 0.0.0.0 --port 5000
+"""
+import asyncio
+import os
+import sys
+import urllib.parse
+from datetime import datetime
+
+import history
+import store
+import throttle
+import webhooks
+
+base = os.path.dirname(os.path.abspath(__file__))
+UPDATE_INTERVAL_MINUTES = 15
+FETCH_TIMEOUT_SECONDS = 120
+
+cfg = history.read_document(os.path.join(base, 'config.json')) or {}
+schedule_store = store.ScheduleStore(base, use_archive=history.load_settings(cfg)['archive'], background=True)
+rate_limit_settings = throttle.load_settings(cfg)
+request_limiter = throttle.TokenBucketLimiter(rate_limit_settings['rate'], rate_limit_settings['burst'],
+                                              rate_limit_settings['max_clients'])
+update_limiter = throttle.TokenBucketLimiter(rate_limit_settings['update_per_minute'] / 60,
+                                             rate_limit_settings['update_burst'], rate_limit_settings['max_clients'])
+
+last_update = {
+    'timestamp': None,
+    'status': 'pending',
+    'message': 'Чекання першого оновлення...'
+}
+update_in_progress = False
+_background = set()
+webhook_dispatcher = webhooks.WebhookDispatcher(base, webhooks.load_settings(cfg))
+
+
+async def update_data_task():
+    """Запуск парсера для оновлення даних (не блокує event loop)"""
+    global last_update, update_in_progress
+
+    if update_in_progress:
+        print("Оновлення вже в процесі...")
+        return
+
+    update_in_progress = True
+    proc = None
+    try:
+        fetcher = os.path.join(base, 'fetcher.py')
+        print(f"[{datetime.now()}] Запуск парсера...")
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, fetcher, cwd=base,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+        _stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=FETCH_TIMEOUT_SECONDS)
+        stderr = stderr.decode('utf-8', errors='replace')
+
+        if proc.returncode == 0:
+            last_update = {
+                'timestamp': datetime.now().isoformat(),
+                'status': 'success',
+                'message': 'Дані оновлено успішно!'
+            }
+            print("✓ Дані оновлено успішно!")
+            await asyncio.to_thread(schedule_store.refresh)
+            await asyncio.to_thread(webhook_dispatcher.poll_outbox)
+        else:
+            last_update = {
+                'timestamp': datetime.now().isoformat(),
+                'status': 'error',
+                'message': f'Помилка: {stderr[:200]}'
+            }
+            print(f"✗ Помилка оновлення: {stderr}")
+    except asyncio.TimeoutError:
+        if proc is not None and proc.returncode is None:
+            proc.kill()
+            await proc.wait()
+        last_update = {
+            'timestamp': datetime.now().isoformat(),
+            'status': 'error',
+            'message': 'ЧасTimeout - парсер брав надто довго'
+        }
+        print("✗ Timeout: парсер брав надто довго")
+    except Exception as e:
+        last_update = {
+            'timestamp': datetime.now().isoformat(),
+            'status': 'error',
+            'message': f'Помилка: {str(e)[:200]}'
+        }
+        print(f"✗ Помилка: {str(e)}")
+    finally:
+        update_in_progress = False
+
+
+def start_update():
+    task = asyncio.create_task(update_data_task())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+async def scheduler_loop():
+    print("API стартує... Запуск першого оновлення даних...")
+    while True:
+        start_update()
+        await asyncio.sleep(UPDATE_INTERVAL_MINUTES * 60)
+
+
+def query_int(query, name):
+    """Like Flask's request.args.get(name, type=int)"""
+    try:
+        return int(query[name])
+    except (KeyError, ValueError):
+        return None
+
+
+def get_cities(query):
+    data = schedule_store.cities()
+    return (data if data is not None else {"cities": []}), 200
+
+
+def get_status(query):
+    return {
+        'last_update': last_update,
+        'parsing_in_progress': update_in_progress,
+        'auto_update_interval_minutes': UPDATE_INTERVAL_MINUTES
+    }, 200
+
+
+def trigger_update(query):
+    if update_in_progress:
+        return {
+            'status': 'in_progress',
+            'message': 'Оновлення вже в процесі...'
+        }, 202
+    start_update()
+    return {
+        'status': 'started',
+        'message': 'Оновлення запущено',
+        'last_update': last_update
+    }, 202
+
+
+def get_schedules(query):
+    return store.history_response(schedule_store, query_int(query, 'channel_id'), query.get('date'),
+                                  query.get('queue'))
+
+
+def get_schedules_today(query):
+    return store.day_response(schedule_store, 'today', query_int(query, 'channel_id'), query.get('queue'))
+
+
+def get_schedules_tomorrow(query):
+    return store.day_response(schedule_store, 'tomorrow', query_int(query, 'channel_id'), query.get('queue'))
+
+
+ROUTES = {
+    '/api/cities': ('GET', get_cities),
+    '/api/status': ('GET', get_status),
+    '/api/update': ('POST', trigger_update),
+    '/api/schedules': ('GET', get_schedules),
+    '/api/schedules/today': ('GET', get_schedules_today),
+    '/api/schedules/tomorrow': ('GET', get_schedules_tomorrow),
+}
+
+
+async def call_handler(handler, query):
+    """(body, status) of a handler; values the store has not loaded yet are loaded in a thread"""
+    while True:
+        try:
+            return handler(query)
+        except store.NotLoaded as e:
+            await asyncio.to_thread(e.load)
+
+
+async def send_json(send, body, status, extra_headers=()):
+    payload = store.dumps(body).encode('utf-8')
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(payload)).encode()),
+            *extra_headers,
+        ],
+    })
+    await send({'type': 'http.response.body', 'body': payload})
+
+
+async def lifespan(receive, send):
+    scheduler = None
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            webhook_dispatcher.start()
+            scheduler = asyncio.create_task(scheduler_loop())
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if scheduler is not None:
+                scheduler.cancel()
+            webhook_dispatcher.stop()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    if rate_limit_settings['enabled'] and scope['path'].startswith('/api/'):
+        headers = dict(scope.get('headers') or [])
+        forwarded_for = headers.get(b'x-forwarded-for', b'').decode('latin-1')
+        client = throttle.client_address((scope.get('client') or (None,))[0], forwarded_for,
+                                         rate_limit_settings['trusted_proxies'])
+        wait = request_limiter.acquire(client)
+        if not wait and scope['path'] == '/api/update':
+            wait = update_limiter.acquire(client)
+        if wait:
+            await send_json(send, {"error": "Забагато запитів, спробуйте пізніше"}, 429,
+                            [(b'retry-after', throttle.retry_after_header(wait).encode())])
+            return
+
+    route = ROUTES.get(scope['path'])
+    if route is None:
+        await send_json(send, {"error": "Not Found"}, 404)
+        return
+    method, handler = route
+    if scope['method'] != method:
+        await send_json(send, {"error": "Method Not Allowed"}, 405)
+        return
+
+    # First value wins for repeated keys, as with Flask's request.args.get
+    query = {}
+    for key, value in urllib.parse.parse_qsl(scope.get('query_string', b'').decode('latin-1'),
+                                             keep_blank_values=True):
+        query.setdefault(key, value)
+    body, status = await call_handler(handler, query)
+    await send_json(send, body, status)
@@ -0,0 +1,527 @@
+"""HTTP load test and latency benchmark for the schedule API.
+
+Usage:
+    python benchmark.py run --years 1 3 5 --channels 5 --concurrency 1 8 32
+    python benchmark.py run --url http://127.0.0.1:5000 --concurrency 16
+    python benchmark.py compare benchmarks/a.json benchmarks/b.json
+    python benchmark.py parser --fuzz 20000
+
+`run` copies the backend code into a scratch directory, fills it with
+synthetic schedule files, starts the API there and drives the read
+endpoints. Results are saved to benchmarks/ for later comparison.
+
+`parser` feeds real-looking posts, adversarial inputs and random fuzz to
+the message parser, reports the worst parse times and checks that every
+guarded parse returns within the configured time budget.
+"""
+import argparse
+import asyncio
+import datetime
+import glob
+import http.client
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+base = os.path.dirname(os.path.abspath(__file__))
+results_dir = os.path.join(base, 'benchmarks')
+
+QUEUES = [f'{q}.{s}' for q in range(1, 7) for s in (1, 2)]
+ENDPOINTS = ['cities', 'schedules', 'today', 'tomorrow']
+
+
+def random_day_schedule(rng):
+    """Random outage intervals on a 30 minute grid, like real ГПВ posts"""
+    schedule = {}
+    for queue in QUEUES:
+        periods = []
+        slot = rng.randint(0, 8)
+        while slot < 48:
+            length = rng.randint(4, 9)
+            end = min(slot + length, 48)
+            start_text = f'{slot // 2:02d}:{slot % 2 * 30:02d}'
+            end_text = '00:00' if end == 48 else f'{end // 2:02d}:{end % 2 * 30:02d}'
+            periods.append(f'{start_text}-{end_text}')
+            slot = end + rng.randint(3, 10)
+        schedule[queue] = periods
+    return schedule
+
+
+def generate_data(data_dir, years, channels, seed=42):
+    """Write cities, today, tomorrow and `years` of history for `channels` channels"""
+    rng = random.Random(seed)
+    today = datetime.date.today()
+    tomorrow = today + datetime.timedelta(days=1)
+
+    cities = {'cities': [{'id': cid, 'name': f'Місто {cid}'} for cid in range(1, channels + 1)]}
+    with open(os.path.join(data_dir, 'cities.json'), 'w', encoding='utf-8') as f:
+        json.dump(cities, f, ensure_ascii=False, indent=2)
+
+    def entry(cid, date):
+        return {
+            'channel_id': cid,
+            'schedule_date': str(date),
+            'schedule_time': f'{rng.randint(0, 23):02d}:{rng.randint(0, 59):02d}:00',
+            'schedule': random_day_schedule(rng),
+            'emergency_outages': rng.random() < 0.1,
+        }
+
+    for name, date in (('schedule_today.json', today), ('schedule_tomorrow.json', tomorrow)):
+        with open(os.path.join(data_dir, name), 'w', encoding='utf-8') as f:
+            json.dump([entry(cid, date) for cid in range(1, channels + 1)], f, ensure_ascii=False, indent=4)
+
+    days = int(years * 365)
+    for cid in range(1, channels + 1):
+        history = [entry(cid, today - datetime.timedelta(days=i)) for i in range(1, days + 1)]
+        with open(os.path.join(data_dir, f'schedule_history_{cid}.json'), 'w', encoding='utf-8') as f:
+            json.dump(history, f, ensure_ascii=False, indent=4)
+    return days
+
+
+def prepare_sandbox(work_dir):
+    """Copy the API code (but no config.json, so the parser stays idle)"""
+    for path in glob.glob(os.path.join(base, '*.py')):
+        shutil.copy(path, work_dir)
+    shutil.copytree(os.path.join(base, 'templates'), os.path.join(work_dir, 'templates'))
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(work_dir, port):
+    code = f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True, use_reloader=False)"
+    proc = subprocess.Popen([sys.executable, '-c', code], cwd=work_dir,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError('API server exited during startup')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return proc
+        except OSError:
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError('API server did not start in 30 seconds')
+
+
+def build_paths(endpoint, count, channels, days, rng):
+    """Request paths for one endpoint with random channels, queues and dates"""
+    today = datetime.date.today()
+    paths = []
+    for _ in range(count):
+        cid = rng.randint(1, channels)
+        queue = rng.choice([None] + QUEUES)
+        query = {'channel_id': cid}
+        if queue:
+            query['queue'] = queue
+        if endpoint == 'cities':
+            paths.append('/api/cities')
+            continue
+        if endpoint == 'schedules':
+            query['date'] = str(today - datetime.timedelta(days=rng.randint(1, max(days, 1))))
+            path = '/api/schedules'
+        else:
+            path = f'/api/schedules/{endpoint}'
+        paths.append(f'{path}?{urllib.parse.urlencode(query)}')
+    return paths
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    idx = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values))) - 1))
+    return sorted_values[idx]
+
+
+def drive(host, port, paths, concurrency):
+    """Send `paths` with `concurrency` keep-alive connections, return latency stats"""
+    latencies = []
+    errors = [0]
+    rate_limited = [0]
+    client_errors = [0]
+    lock = threading.Lock()
+    cursor = iter(paths)
+
+    def worker():
+        conn = http.client.HTTPConnection(host, port, timeout=30)
+        local = []
+        while True:
+            with lock:
+                path = next(cursor, None)
+            if path is None:
+                break
+            started = time.perf_counter()
+            try:
+                conn.request('GET', path)
+                resp = conn.getresponse()
+                resp.read()
+                if resp.getheader('Connection', '').lower() == 'close':
+                    conn.close()
+                # Failed and rejected requests say nothing about serving latency
+                if resp.status >= 500:
+                    with lock:
+                        errors[0] += 1
+                    continue
+                if resp.status == 429:
+                    with lock:
+                        rate_limited[0] += 1
+                    continue
+                if resp.status >= 400:
+                    with lock:
+                        client_errors[0] += 1
+                    continue
+            except (OSError, http.client.HTTPException):
+                with lock:
+                    errors[0] += 1
+                conn.close()
+                conn = http.client.HTTPConnection(host, port, timeout=30)
+                continue
+            local.append(time.perf_counter() - started)
+        conn.close()
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        'requests': len(paths),
+        'errors': errors[0],
+        'rate_limited': rate_limited[0],
+        'client_errors': client_errors[0],
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1] if latencies else None),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=base, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def print_row(label, stats):
+    print(f"{label:<40} {stats['throughput_rps']!s:>9} rps  p50 {stats['p50_ms']!s:>8} ms  "
+          f"p95 {stats['p95_ms']!s:>8} ms  p99 {stats['p99_ms']!s:>8} ms  errors {stats['errors']}  "
+          f"429 {stats.get('rate_limited', 0)}  4xx {stats.get('client_errors', 0)}")
+
+
+def total_errors(runs):
+    """5xx, connection errors and 429: requests that were not served at all"""
+    return sum(r['errors'] + r.get('rate_limited', 0) for run in runs for r in run['results'])
+
+
+def total_client_errors(runs):
+    return sum(r.get('client_errors', 0) for run in runs for r in run['results'])
+
+
+def run_suite(host, port, endpoints, concurrencies, requests_count, channels, days, seed):
+    rng = random.Random(seed)
+    results = []
+    for endpoint in endpoints:
+        paths = build_paths(endpoint, requests_count, channels, days, rng)
+        drive(host, port, paths[:min(50, len(paths))], 1)  # warm-up
+        for concurrency in concurrencies:
+            stats = drive(host, port, paths, concurrency)
+            stats.update({'endpoint': endpoint, 'concurrency': concurrency})
+            print_row(f'{endpoint} c={concurrency}', stats)
+            results.append(stats)
+    return results
+
+
+def cmd_run(args):
+    runs = []
+    if args.url:
+        parsed = urllib.parse.urlparse(args.url)
+        print(f'Benchmarking {args.url}')
+        runs.append({
+            'years': None,
+            'results': run_suite(parsed.hostname, parsed.port or 80, args.endpoints, args.concurrency,
+                                 args.requests, args.channels, args.days, args.seed),
+        })
+    else:
+        for years in args.years:
+            with tempfile.TemporaryDirectory(prefix='gpv_bench_') as work_dir:
+                prepare_sandbox(work_dir)
+                days = generate_data(work_dir, years, args.channels, args.seed)
+                history_bytes = sum(os.path.getsize(p) for p in glob.glob(os.path.join(work_dir, 'schedule_history_*.json')))
+                print(f'\n=== {years} year(s), {args.channels} channels, '
+                      f'{history_bytes / 1024 / 1024:.1f} MiB of history ===')
+                port = free_port()
+                proc = start_server(work_dir, port)
+                try:
+                    results = run_suite('127.0.0.1', port, args.endpoints, args.concurrency,
+                                        args.requests, args.channels, days, args.seed)
+                finally:
+                    proc.terminate()
+                    proc.wait(timeout=10)
+                runs.append({'years': years, 'history_bytes': history_bytes, 'results': results})
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'git_revision': git_revision(),
+        'python': sys.version.split()[0],
+        'channels': args.channels,
+        'requests_per_case': args.requests,
+        'failed_requests': total_errors(runs),
+        'client_errors': total_client_errors(runs),
+        'runs': runs,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{report['git_revision'] or 'nogit'}.json"
+    out_path = os.path.join(args.output_dir, name)
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    print(f'\nResults saved to {out_path}')
+    client_errors = total_client_errors(runs)
+    if client_errors:
+        print(f'{client_errors} requests got 4xx (e.g. no schedule for the date); their latencies are excluded')
+    errors = total_errors(runs)
+    if errors:
+        print(f'\n!!! {errors} requests failed (5xx, 429 or connection errors); '
+              f'their latencies are excluded and the results are not comparable. '
+              f'Disable rate_limit on the benchmarked server !!!')
+        sys.exit(1)
+
+
+FUZZ_TOKENS = ['1', '12', '1.1', '6.2', '00:00', '12:30', '08.00', '-', ' - ', '–', '—', ':', ',', ';', '.',
+               ' ', '   ', '\u00a0', '\n', 'черга', 'Черга 3.1', 'графік', 'Графік погодинних вимкнень', 'лютого',
+               '12 лютого', '09/02', 'ГАВ', 'скасовано', '🔹', '⚡', '•', 'a', 'x' * 10]
+ADVERSARIAL = {
+    'whitespace_run': lambda n: '12 ' + ' ' * (n - 4) + 'x',
+    'queue_whitespace': lambda n: '1.1' + ' ' * (n - 4) + 'x',
+    'header_whitespace': lambda n: 'черга' + ' ' * (n - 6) + 'x',
+    'digit_space_runs': lambda n: ('1' + ' ' * 50) * (n // 51),
+    'digits_only': lambda n: '1' * n,
+    'inline_periods': lambda n: '1.1 ' + '00:00-01:00, ' * (n // 13),
+    'queue_lines': lambda n: ('1.1: 1' + ' ' * 100 + 'x\n') * (n // 108),
+    'hour_dash_spaces': lambda n: '1.1: ' + ('1 ' + ' ' * 200) * (n // 203),
+    'graph_lines': lambda n: 'черга 1.1 графік: ' + ('1' + ' ' * 60) * (n // 61),
+    'many_lines': lambda n: '\n' * n,
+}
+
+
+GUARD_PROBE = '\x00stall'
+
+
+def probe_parse(text):
+    """parse_message, except that GUARD_PROBE never returns: a parse the guard must cut off"""
+    if text == GUARD_PROBE:
+        while True:
+            time.sleep(1)
+    import fetcher
+    return fetcher.parse_message(text)
+
+
+def check_guard(fetcher, parse_guard, timeout, slack, post):
+    """Drive a runaway parse through the fetcher's guard: it must time out within the
+    budget, be quarantined, and the next message must parse on a fresh worker"""
+    fetcher.parse_worker = parse_guard.GuardedWorker(probe_parse, timeout)
+    try:
+        fetcher.parse_worker.call('')
+        started = time.perf_counter()
+        try:
+            fetcher.parse_worker.call(GUARD_PROBE)
+            reason = None
+        except parse_guard.GuardTripped as e:
+            reason = e.reason
+        seconds = time.perf_counter() - started
+        recovered = bool(fetcher.parse_worker.call(post))
+        quarantined = asyncio.run(fetcher.guarded_parse(0, 1, GUARD_PROBE)) is None and (0, 1) in fetcher.quarantine
+    finally:
+        fetcher.parse_worker.close()
+        fetcher.parse_worker = None
+    ok = reason == 'timeout' and seconds <= timeout + slack and recovered and quarantined
+    print(f'guard check: tripped {reason} after {seconds * 1000:.1f} ms, next call on a fresh worker '
+          f'{"ok" if recovered else "FAILED"}, quarantined {quarantined} -> {"ok" if ok else "FAILED"}')
+    return {'reason': reason, 'seconds': round(seconds, 3), 'recovered': recovered,
+            'quarantined': quarantined, 'ok': ok}
+
+
+def schedule_post(rng):
+    """A post in the format the channels publish"""
+    lines = [f'Графік погодинних вимкнень на {rng.randint(1, 28)} лютого', '']
+    for queue, periods in random_day_schedule(rng).items():
+        lines.append(f'🔹 {queue}: ' + ', '.join(p.replace('-', ' - ') for p in periods))
+    return '\n'.join(lines)
+
+
+def parser_cases(rng, limit, fuzz_count):
+    cases = [('post', schedule_post(rng)) for _ in range(200)]
+    for name, build in ADVERSARIAL.items():
+        for size in sorted({limit // 4, limit // 2, limit}):
+            cases.append((name, build(size)[:limit]))
+    for _ in range(fuzz_count):
+        text = ''.join(rng.choice(FUZZ_TOKENS) for _ in range(rng.randint(1, 400)))
+        cases.append(('fuzz', text[:limit]))
+    return cases
+
+
+def cmd_parser(args):
+    with tempfile.TemporaryDirectory(prefix='gpv_parser_') as work_dir:
+        prepare_sandbox(work_dir)
+        parser_cfg = {'timeout': args.timeout}
+        if args.max_chars:
+            parser_cfg['max_message_chars'] = args.max_chars
+        with open(os.path.join(work_dir, 'config.json'), 'w', encoding='utf-8') as f:
+            json.dump({'api_id': 1, 'api_hash': 'benchmark', 'channels': [{'id': 1}], 'parser': parser_cfg}, f)
+        sys.path.insert(0, work_dir)
+        import fetcher
+        import parse_guard
+
+        limit = fetcher.parse_settings['max_message_chars']
+        cases = parser_cases(random.Random(args.seed), limit, args.fuzz)
+        print(f'{len(cases)} inputs up to {limit} chars, time budget {args.timeout}s')
+
+        inline = {}
+        for name, text in cases:
+            started = time.perf_counter()
+            try:
+                fetcher.parse_message(text)
+            except Exception as e:
+                print(f'{name}: parser raised {e!r}')
+            inline.setdefault(name, []).append(time.perf_counter() - started)
+
+        worker = parse_guard.GuardedWorker(fetcher.parse_message, args.timeout)
+        guarded = []
+        trips = {}
+        try:
+            worker.call('')  # start the worker outside the measurements
+            for name, text in cases:
+                started = time.perf_counter()
+                try:
+                    worker.call(text)
+                except parse_guard.GuardTripped as e:
+                    trips[e.reason] = trips.get(e.reason, 0) + 1
+                guarded.append(time.perf_counter() - started)
+        finally:
+            worker.close()
+
+        guard = None
+        if args.timeout > 0:
+            guard = check_guard(fetcher, parse_guard, args.timeout, args.slack,
+                                schedule_post(random.Random(args.seed)))
+
+    families = {}
+    for name, times in inline.items():
+        times.sort()
+        families[name] = {
+            'count': len(times),
+            'p50_ms': round(percentile(times, 50) * 1000, 3),
+            'p99_ms': round(percentile(times, 99) * 1000, 3),
+            'max_ms': round(times[-1] * 1000, 3),
+        }
+        print(f"{name:<20} n={len(times):<6} p50 {families[name]['p50_ms']:>9} ms  "
+              f"p99 {families[name]['p99_ms']:>9} ms  max {families[name]['max_ms']:>9} ms")
+    guarded_max = max(guarded) if guarded else 0.0
+    # Killing and replacing a worker is not part of the budget, a generous slack covers it
+    bounded = guarded_max <= args.timeout + args.slack
+    print(f'guarded: {len(guarded)} calls, max {guarded_max * 1000:.1f} ms, trips {trips or 0} -> '
+          f'{"bounded" if bounded else "NOT bounded"}')
+
+    report = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'git_revision': git_revision(),
+        'python': sys.version.split()[0],
+        'max_message_chars': limit,
+        'timeout': args.timeout,
+        'families': families,
+        'guarded_calls': len(guarded),
+        'guarded_max_ms': round(guarded_max * 1000, 3),
+        'guard_trips': trips,
+        'bounded': bounded,
+        'guard_check': guard,
+    }
+    os.makedirs(args.output_dir, exist_ok=True)
+    name = f"parser_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}_{report['git_revision'] or 'nogit'}.json"
+    out_path = os.path.join(args.output_dir, name)
+    with open(out_path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+    print(f'Results saved to {out_path}')
+    if not bounded or (guard and not guard['ok']):
+        sys.exit(1)
+
+
+def cmd_compare(args):
+    with open(args.old, 'r', encoding='utf-8') as f:
+        old = json.load(f)
+    with open(args.new, 'r', encoding='utf-8') as f:
+        new = json.load(f)
+
+    def index(report):
+        return {(run['years'], r['endpoint'], r['concurrency']): r for run in report['runs'] for r in run['results']}
+
+    old_idx, new_idx = index(old), index(new)
+    print(f"{old.get('git_revision')} -> {new.get('git_revision')}")
+    for key in sorted(set(old_idx) & set(new_idx), key=str):
+        a, b = old_idx[key], new_idx[key]
+        parts = []
+        for metric in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+            if a[metric] and b[metric] is not None:
+                parts.append(f'{metric} {a[metric]} -> {b[metric]} ({(b[metric] - a[metric]) / a[metric] * 100:+.1f}%)')
+        years, endpoint, concurrency = key
+        print(f'years={years} {endpoint} c={concurrency}: ' + ', '.join(parts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Schedule API benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    run = sub.add_parser('run', help='generate data, start the API and measure latency')
+    run.add_argument('--url', help='benchmark an already running server instead of a local sandbox')
+    run.add_argument('--years', type=float, nargs='+', default=[1, 3, 5])
+    run.add_argument('--channels', type=int, default=5)
+    run.add_argument('--days', type=int, default=30, help='date range for /api/schedules when using --url')
+    run.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    run.add_argument('--requests', type=int, default=2000, help='requests per endpoint and concurrency level')
+    run.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=ENDPOINTS)
+    run.add_argument('--seed', type=int, default=42)
+    run.add_argument('--output-dir', default=results_dir)
+    run.set_defaults(func=cmd_run)
+
+    compare = sub.add_parser('compare', help='compare two saved result files')
+    compare.add_argument('old')
+    compare.add_argument('new')
+    compare.set_defaults(func=cmd_compare)
+
+    parse = sub.add_parser('parser', help='fuzz the message parser and check the guarded time budget')
+    parse.add_argument('--fuzz', type=int, default=5000, help='number of random inputs')
+    parse.add_argument('--timeout', type=float, default=2.0, help='parse time budget in seconds')
+    parse.add_argument('--max-chars', type=int, help='message size limit (default: parser config default)')
+    parse.add_argument('--slack', type=float, default=1.0,
+                       help='allowed overshoot in seconds, covers restarting a killed worker')
+    parse.add_argument('--seed', type=int, default=42)
+    parse.add_argument('--output-dir', default=results_dir)
+    parse.set_defaults(func=cmd_parser)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
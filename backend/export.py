@@ -0,0 +1,253 @@
+"""Static, pre-rendered export of the read-only API for nginx/CDN serving.
+
+After a fetch cycle every GET response is rendered with the same code as
+the API (store.py) into a versioned directory tree that mirrors the API
+paths, each file next to a pre-compressed .gz copy:
+
+    export/current -> export/20260212_205740_123456
+        api/cities.json
+        api/schedules/today/<channel_id>.json
+        api/schedules/today/<channel_id>/<queue>.json
+        api/schedules/tomorrow/<channel_id>.json
+        api/schedules/tomorrow/<channel_id>/<queue>.json
+        api/schedules/<channel_id>/<date>.json
+        api/schedules/<channel_id>/<date>/<queue>.json
+
+The `current` symlink is switched atomically once a version is complete.
+Past dates are incremental: the manifest keeps a content hash per
+(channel, date), and a date whose hash matches the previous version is
+hard-linked from it instead of rendered again. Only today, tomorrow and
+changed dates are written, so a version costs a few files plus links.
+
+Usage:
+    python export.py
+"""
+import datetime
+import glob
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+import store
+
+MANIFEST = 'manifest.json'
+
+
+def load_settings(cfg, base):
+    """Read the `export` config section"""
+    section = cfg.get('export', {})
+    return {
+        'enabled': bool(section.get('enabled', False)),
+        'dir': os.path.join(base, section.get('dir', 'export')),
+        'keep_versions': max(1, int(section.get('keep_versions', 3))),
+        # null exports the whole history
+        'history_days': section.get('history_days', 30) or None,
+    }
+
+
+def source_digest(base):
+    """Content hash of every file the export is built from"""
+    digest = hashlib.sha1()
+    names = ['cities.json', 'schedule_today.json', 'schedule_tomorrow.json']
+    names += sorted(os.path.basename(p) for p in glob.glob(os.path.join(base, 'schedule_history_*.json')))
+    for name in names:
+        digest.update(name.encode('utf-8'))
+        try:
+            with open(os.path.join(base, name), 'rb') as f:
+                digest.update(f.read())
+        except OSError:
+            pass
+    return digest.hexdigest()
+
+
+def _write(root, rel_path, body):
+    path = os.path.join(root, *rel_path.split('/'))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = store.dumps(body).encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(data)
+    with open(f'{path}.gz', 'wb') as f:
+        f.write(gzip.compress(data, compresslevel=9, mtime=0))
+
+
+def _link_tree(previous_root, root, rel_prefix):
+    """Hard-link `<rel_prefix>.json(.gz)` and everything under `<rel_prefix>/` from the
+    previous version, False when any of it is missing"""
+    src = os.path.join(previous_root, *rel_prefix.split('/'))
+    dst = os.path.join(root, *rel_prefix.split('/'))
+    pairs = [(f'{src}.json', f'{dst}.json'), (f'{src}.json.gz', f'{dst}.json.gz')]
+    for dirpath, _dirnames, filenames in os.walk(src):
+        for name in filenames:
+            path = os.path.join(dirpath, name)
+            pairs.append((path, os.path.join(dst, os.path.relpath(path, src))))
+    try:
+        for src_path, dst_path in pairs:
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            try:
+                os.link(src_path, dst_path)
+            except OSError as e:
+                if isinstance(e, FileNotFoundError):
+                    raise
+                # Filesystems without hard links get a copy
+                shutil.copy2(src_path, dst_path)
+    except FileNotFoundError:
+        shutil.rmtree(dst, ignore_errors=True)
+        for _src_path, dst_path in pairs[:2]:
+            if os.path.exists(dst_path):
+                os.remove(dst_path)
+        return False
+    return len(pairs)
+
+
+def _day_hash(city_name, entry):
+    return hashlib.sha1(store.dumps([city_name, entry]).encode('utf-8')).hexdigest()
+
+
+def render_tree(base, root, history_days=None, previous=None):
+    """Write every successful GET response under `root`.
+
+    `previous` is (root, date_hashes) of the live version; history dates with
+    an unchanged hash are hard-linked from it. Returns (documents, rendered,
+    date_hashes) where `rendered` counts documents actually written.
+    """
+    schedule_store = store.ScheduleStore(base)
+    previous_root, previous_hashes = previous or (None, {})
+    count = 0
+    rendered = 0
+    date_hashes = {}
+
+    cities = schedule_store.cities()
+    _write(root, 'api/cities.json', cities if cities is not None else {"cities": []})
+    count += 1
+    rendered += 1
+
+    channel_ids = {city['id'] for city in (cities or {}).get('cities', [])}
+    for kind in ('today', 'tomorrow'):
+        channel_ids.update(cid for cid in schedule_store.day_items(kind) if isinstance(cid, int))
+    for path in glob.glob(os.path.join(base, 'schedule_history_*.json')):
+        try:
+            channel_ids.add(int(os.path.basename(path)[len('schedule_history_'):-len('.json')]))
+        except ValueError:
+            pass
+
+    cutoff = None
+    if history_days:
+        cutoff = str(datetime.date.today() - datetime.timedelta(days=history_days))
+
+    def emit(rel_prefix, body, status):
+        nonlocal count, rendered
+        if status != 200:
+            return
+        _write(root, f'{rel_prefix}.json', body)
+        count += 1
+        rendered += 1
+
+    for channel_id in sorted(channel_ids):
+        for kind in ('today', 'tomorrow'):
+            prefix = f'api/schedules/{kind}/{channel_id}'
+            body, status = store.day_response(schedule_store, kind, channel_id, None)
+            emit(prefix, body, status)
+            if status == 200:
+                for queue in body['schedule']:
+                    emit(f'{prefix}/{queue}', *store.day_response(schedule_store, kind, channel_id, queue))
+
+        city_name = schedule_store.city_name(channel_id)
+        channel_hashes = {}
+        previous_channel = previous_hashes.get(str(channel_id), {})
+        for date, entry in schedule_store.channel_history(channel_id).items():
+            if not date or (cutoff and date < cutoff):
+                continue
+            prefix = f'api/schedules/{channel_id}/{date}'
+            day_hash = channel_hashes[date] = _day_hash(city_name, entry)
+            if previous_root and previous_channel.get(date) == day_hash:
+                linked = _link_tree(previous_root, root, prefix)
+                if linked:
+                    count += linked // 2
+                    continue
+            body, status = store.history_response(schedule_store, channel_id, date, None)
+            emit(prefix, body, status)
+            if status == 200:
+                for queue in body['schedule']:
+                    emit(f'{prefix}/{queue}', *store.history_response(schedule_store, channel_id, date, queue))
+        if channel_hashes:
+            date_hashes[str(channel_id)] = channel_hashes
+    return count, rendered, date_hashes
+
+
+def _switch_current(export_dir, version):
+    current = os.path.join(export_dir, 'current')
+    tmp_link = os.path.join(export_dir, f'.current.{os.getpid()}')
+    if os.path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(version, tmp_link, target_is_directory=True)
+    os.replace(tmp_link, current)
+
+
+def _current_manifest(export_dir):
+    try:
+        with open(os.path.join(export_dir, 'current', MANIFEST), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def _prune(export_dir, keep):
+    current = os.path.realpath(os.path.join(export_dir, 'current'))
+    versions = sorted(d for d in os.listdir(export_dir)
+                      if not d.startswith('.') and d != 'current' and os.path.isdir(os.path.join(export_dir, d)))
+    for version in versions[:-keep]:
+        path = os.path.join(export_dir, version)
+        if os.path.realpath(path) != current:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def export_static(base, settings):
+    """Render a new version if the source data changed and make it `current`"""
+    export_dir = settings['dir']
+    os.makedirs(export_dir, exist_ok=True)
+    digest = source_digest(base)
+    previous_manifest = _current_manifest(export_dir)
+    if previous_manifest.get('source_digest') == digest:
+        return None
+
+    previous = None
+    if previous_manifest.get('history_days', 'unset') == settings['history_days']:
+        previous = (os.path.realpath(os.path.join(export_dir, 'current')), previous_manifest.get('dates', {}))
+
+    version = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    root = os.path.join(export_dir, version)
+    try:
+        count, rendered, date_hashes = render_tree(base, root, settings['history_days'], previous)
+        manifest = {
+            'version': version,
+            'generated_at': datetime.datetime.now().isoformat(),
+            'source_digest': digest,
+            'documents': count,
+            'rendered': rendered,
+            'history_days': settings['history_days'],
+            'dates': date_hashes,
+        }
+        with open(os.path.join(root, MANIFEST), 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        _switch_current(export_dir, version)
+    except BaseException:
+        shutil.rmtree(root, ignore_errors=True)
+        raise
+    _prune(export_dir, settings['keep_versions'])
+    return manifest
+
+
+if __name__ == '__main__':
+    base = os.path.dirname(os.path.abspath(__file__))
+    cfg_path = os.path.join(base, 'config.json')
+    cfg = {}
+    if os.path.exists(cfg_path):
+        with open(cfg_path, 'r', encoding='utf-8') as f:
+            cfg = json.load(f)
+    result = export_static(base, load_settings(cfg, base))
+    if result:
+        print(f"Exported {result['documents']} documents ({result['rendered']} rendered) to version {result['version']}")
+    else:
+        print('Export is up to date')
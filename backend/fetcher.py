@@ -2,16 +2,30 @@ import os
 import json
 import sys
 import asyncio
+import concurrent.futures
+import copy
 import datetime
+import multiprocessing
 import re
 import time
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
+
+import archive
+import export
+import history
+import metrics
+import parse_guard
+import profiling
+import webhooks
 
 base = os.path.dirname(__file__)
 config_path = os.path.join(base, 'config.json')
 today_file = os.path.join(base, 'schedule_today.json')
 history_file_template = os.path.join(base, 'schedule_history_{}.json')
 tomorrow_file = os.path.join(base, 'schedule_tomorrow.json')
+metrics_file = os.path.join(base, 'fetch_metrics.json')
+shard_state_file = os.path.join(base, 'shard_state.json')
 
 if not os.path.exists(config_path):
     print('No config.json found in backend/. Create backend/config.json from config.example.json')
@@ -24,17 +38,48 @@ api_id = cfg.get('api_id')
 api_hash = cfg.get('api_hash')
 channels = cfg.get('channels', [])
 session_path = os.path.join(base, cfg.get('session_path', 'session_name'))
+sessions = [
+    {
+        'name': s.get('name', s.get('session_path')),
+        'session_path': os.path.join(base, s.get('session_path', 'session_name')),
+        'api_id': s.get('api_id', api_id),
+        'api_hash': s.get('api_hash', api_hash),
+    }
+    for s in cfg.get('sessions', [])
+] or [{'name': 'default', 'session_path': session_path, 'api_id': api_id, 'api_hash': api_hash}]
 
 batch_config = cfg.get('batch_parser', {})
 batch_size = batch_config.get('batch_size', 2)
 batch_delay = batch_config.get('batch_delay', 5)
 limit_messages = batch_config.get('limit_messages', 200)
 timezone_offset = cfg.get('timezone_offset', 2)
+profile_settings = profiling.load_settings(cfg, base)
+history_settings = history.load_settings(cfg)
+export_settings = export.load_settings(cfg, base)
+parse_settings = parse_guard.load_settings(cfg)
+quarantine = parse_guard.Quarantine(os.path.join(base, 'parse_quarantine'), parse_settings['quarantine_days'])
+parse_worker = None
 
 if not all([api_id, api_hash, channels]):
     print('Missing required config values: api_id, api_hash, channels')
     sys.exit(1)
 
+registry = metrics.Registry()
+registry.describe('fetcher_cycles_total', 'Completed fetch cycles by result')
+registry.describe('fetcher_cycle_duration_seconds', 'Wall time of a whole fetch cycle')
+registry.describe('fetcher_phase_duration_seconds', 'Wall time spent in each fetch cycle phase')
+registry.describe('fetcher_telegram_request_duration_seconds', 'Latency of Telegram API requests')
+registry.describe('fetcher_messages_checked_total', 'Messages read from a channel')
+registry.describe('fetcher_schedule_messages_total', 'Messages detected as schedule posts')
+registry.describe('fetcher_parse_failures_total', 'Schedule posts without a parsable date or schedule')
+registry.describe('fetcher_flood_waits_total', 'Telegram flood wait errors')
+registry.describe('fetcher_errors_total', 'Channels that failed with an error')
+registry.describe('fetcher_messages_skipped_total', 'Messages not parsed: oversized or quarantined')
+registry.describe('fetcher_parse_guard_trips_total', 'Messages whose parse timed out or crashed, now quarantined')
+registry.describe('fetcher_export_failures_total', 'Static API exports that failed')
+registry.describe('fetcher_archive_failures_total', 'History archive rebuilds that failed')
+registry.describe('fetcher_shard_rebalances_total', 'Channels moved to another session after a flood wait')
+
 def is_power_outage_schedule(text):
     """Check if message contains power outage schedule"""
     if text is None:
@@ -198,7 +243,7 @@ def parse_schedule(text):
         line = re.sub(r'[🔹❗✅➡️💡⚠️🗓📍⚡🏆⌛️]+', '', line).strip()
         line = re.sub(r'^[\s\-\*\u2022\u25CF\u25CB\u25A0\u25AA\u2219\u2043\u2023•▪▫·●○■□]+', '', line).strip()
 
-        queue_header = re.search(r'(?:черга|група)\s*\[?\s*([0-6](?:\.[12])?)\s*\]?', line, re.IGNORECASE)
+        queue_header = re.search(r'(?:черга|група)\s*(?:\[\s*)?([0-6](?:\.[12])?)\s*\]?', line, re.IGNORECASE)
         if queue_header:
             current_queue = queue_header.group(1).strip()
 
@@ -209,7 +254,7 @@ def parse_schedule(text):
                 schedule[current_queue] = periods
             continue
         
-        match = re.match(r'^([0-6](?:\.[12])?)\s*[:–\-]?\s*(\d{1,2}(?::\d{2})?.*)$', line)
+        match = re.match(r'^([0-6](?:\.[12])?)\s*(?:[:–\-]\s*)?(\d{1,2}(?::\d{2})?.*)$', line)
         if match:
             queue = match.group(1).strip()
             times_str = match.group(2).strip()
@@ -237,7 +282,7 @@ def parse_schedule(text):
         return schedule
 
     inline_pattern = re.compile(
-        r'([0-6](?:\.[12])?)\s*[:\-]?\s*'
+        r'([0-6](?:\.[12])?)\s*(?:[:\-]\s*)?'
         r'((?:\d{1,2}[.:]\d{2}\s*-\s*\d{1,2}[.:]\d{2})(?:\s*[,;]\s*\d{1,2}[.:]\d{2}\s*-\s*\d{1,2}[.:]\d{2})*)'
     )
     for match in inline_pattern.finditer(text):
@@ -294,6 +339,31 @@ def merge_intervals(periods):
             merged.append(cur)
     return [tuple_to_period(t) for t in merged]
 
+def parse_message(text):
+    """(schedule_date, schedule) of a post, schedule is None without a date"""
+    schedule_date = parse_date(text)
+    return schedule_date, (parse_schedule(text) if schedule_date else None)
+
+async def guarded_parse(channel_id, message_id, text):
+    """parse_message under the time budget; None when the message was quarantined"""
+    global parse_worker
+    if parse_settings['timeout'] <= 0:
+        return parse_message(text)
+    if parse_worker is None:
+        parse_worker = parse_guard.GuardedWorker(parse_message, parse_settings['timeout'])
+    try:
+        return await asyncio.to_thread(parse_worker.call, text)
+    except parse_guard.GuardTripped as e:
+        registry.inc('fetcher_parse_guard_trips_total', channel=channel_id, reason=e.reason)
+        quarantine.add(channel_id, message_id, e.reason, len(text), e.seconds)
+        print(f'[ERR] Channel {channel_id}: message {message_id} quarantined, parser {e}')
+        return None
+    except (RuntimeError, OSError, AssertionError) as e:
+        # No worker (e.g. inside a daemonic process): parse unguarded rather than not at all
+        print(f'Parser worker unavailable, parsing inline: {str(e)}')
+        parse_settings['timeout'] = 0
+        return parse_message(text)
+
 def rotate_schedules(today_data, tomorrow_data, all_history, channels):
     """Rotate schedules at midnight: tomorrow -> today, today -> history"""
     tz = datetime.timezone(datetime.timedelta(hours=timezone_offset))
@@ -336,23 +406,44 @@ async def fetch_messages_for_channel(client, channel, today, tomorrow):
     all_found_dates = []
     messages_checked = 0
     schedule_messages_found = 0
+    parse_failures = 0
+    detect_seconds = 0.0
+    parse_seconds = 0.0
     
     try:
-        entity = await client.get_entity(channel_username)
+        with registry.timer('fetcher_phase_duration_seconds', phase='resolve', channel=channel_id), \
+                registry.timer('fetcher_telegram_request_duration_seconds', method='get_entity'):
+            entity = await client.get_entity(channel_username)
         print(f"Processing channel {channel_id} ({channel_name}): {channel_username}")
         
+        iterate_started = time.perf_counter()
         async for message in client.iter_messages(entity, limit=limit_messages):
             messages_checked += 1
             
             msg_text = message.text or message.raw_text or ''
-            if is_power_outage_schedule(msg_text) or has_queue_schedule(msg_text):
+            # Telegram's 4096 limit counts the plain text; markdown in message.text adds to it
+            if len(message.raw_text or msg_text) > parse_settings['max_message_chars']:
+                registry.inc('fetcher_messages_skipped_total', channel=channel_id, reason='size')
+                continue
+            if (channel_id, message.id) in quarantine:
+                registry.inc('fetcher_messages_skipped_total', channel=channel_id, reason='quarantined')
+                continue
+            started = time.perf_counter()
+            is_schedule = is_power_outage_schedule(msg_text) or has_queue_schedule(msg_text)
+            detect_seconds += time.perf_counter() - started
+            if is_schedule:
                 schedule_messages_found += 1
-                schedule_date = parse_date(msg_text)
+                started = time.perf_counter()
+                parsed_message = await guarded_parse(channel_id, message.id, msg_text)
+                parse_seconds += time.perf_counter() - started
+                if parsed_message is None:
+                    parse_failures += 1
+                    continue
+                schedule_date, parsed = parsed_message
                 
                 if schedule_date:
-                    parsed = parse_schedule(msg_text)
-                    
                     if not parsed:
+                        parse_failures += 1
                         continue
 
                     tz = datetime.timezone(datetime.timedelta(hours=timezone_offset))
@@ -387,6 +478,13 @@ async def fetch_messages_for_channel(client, channel, today, tomorrow):
                             'schedule': parsed,
                             'emergency_outages': emergency_flag
                         }
+                else:
+                    parse_failures += 1
+        
+        iterate_seconds = time.perf_counter() - iterate_started - detect_seconds - parse_seconds
+        registry.observe('fetcher_phase_duration_seconds', iterate_seconds, phase='iterate', channel=channel_id)
+        registry.observe('fetcher_phase_duration_seconds', detect_seconds, phase='detect', channel=channel_id)
+        registry.observe('fetcher_phase_duration_seconds', parse_seconds, phase='parse', channel=channel_id)
         
         result_to_return = None
         
@@ -413,24 +511,239 @@ async def fetch_messages_for_channel(client, channel, today, tomorrow):
             print(f"[ERR] Channel {channel_id}: Checked {messages_checked} messages, found {schedule_messages_found} schedule messages{dates_info}")
             return None
         
+    except FloodWaitError as e:
+        registry.inc('fetcher_flood_waits_total', channel=channel_id)
+        print(f'[ERR] Flood wait on channel {channel_id}: {e.seconds} seconds')
+        return {'flood_wait': e.seconds}
     except Exception as e:
+        registry.inc('fetcher_errors_total', channel=channel_id)
         print(f'[ERR] Error fetching from channel {channel_id}: {str(e)}')
         return None
+    finally:
+        registry.inc('fetcher_messages_checked_total', messages_checked, channel=channel_id)
+        registry.inc('fetcher_schedule_messages_total', schedule_messages_found, channel=channel_id)
+        registry.inc('fetcher_parse_failures_total', parse_failures, channel=channel_id)
+
+def merge_channel_result(result, channel_id, today, today_data, tomorrow_data):
+    """Merge one channel's fetch result into today/tomorrow data, return update counts"""
+    today_updated = 0
+    tomorrow_updated = 0
+    today_result = result.get('today')
+    tomorrow_result = result.get('tomorrow')
+    fallback_result = result.get('fallback')
+    # Update today data
+    if today_result:
+        schedule_date = today_result['schedule_date']
+        today_idx = next((i for i, item in enumerate(today_data) if item.get('channel_id') == channel_id), -1)
+        if today_idx != -1:
+            existing = today_data[today_idx].get('schedule', {})
+            for queue, new_periods in today_result['schedule'].items():
+                old_periods = existing.get(queue, [])
+                combined = old_periods + new_periods
+                merged = merge_intervals(combined)
+                existing[queue] = merged
+            today_data[today_idx]['schedule_time'] = today_result['schedule_time']
+            today_data[today_idx]['schedule_date'] = schedule_date
+            today_data[today_idx]['emergency_outages'] = today_result['emergency_outages'] or today_data[today_idx].get('emergency_outages', False)
+        else:
+            today_data.append({
+                'channel_id': channel_id,
+                'schedule_date': schedule_date,
+                'schedule_time': today_result['schedule_time'],
+                'schedule': today_result['schedule'],
+                'emergency_outages': today_result['emergency_outages']
+            })
+        today_updated += 1
+    
+    # Update tomorrow data
+    if tomorrow_result:
+        schedule_date = tomorrow_result['schedule_date']
+        tomorrow_idx = next((i for i, item in enumerate(tomorrow_data) if item.get('channel_id') == channel_id), -1)
+        if tomorrow_idx != -1:
+            existing = tomorrow_data[tomorrow_idx].get('schedule', {})
+            for queue, new_periods in tomorrow_result['schedule'].items():
+                old_periods = existing.get(queue, [])
+                combined = old_periods + new_periods
+                merged = merge_intervals(combined)
+                existing[queue] = merged
+            tomorrow_data[tomorrow_idx]['schedule_time'] = tomorrow_result['schedule_time']
+            tomorrow_data[tomorrow_idx]['schedule_date'] = schedule_date
+            tomorrow_data[tomorrow_idx]['emergency_outages'] = tomorrow_result['emergency_outages'] or tomorrow_data[tomorrow_idx].get('emergency_outages', False)
+        else:
+            tomorrow_data.append({
+                'channel_id': channel_id,
+                'schedule_date': schedule_date,
+                'schedule_time': tomorrow_result['schedule_time'],
+                'schedule': tomorrow_result['schedule'],
+                'emergency_outages': tomorrow_result['emergency_outages']
+            })
+        tomorrow_updated += 1
+    
+    if fallback_result and not today_result:
+        fallback_result['schedule_date'] = today
+        today_idx = next((i for i, item in enumerate(today_data) if item.get('channel_id') == channel_id), -1)
+        if today_idx == -1:
+            today_data.append({
+                'channel_id': channel_id,
+                'schedule_date': today,
+                'schedule_time': fallback_result['schedule_time'],
+                'schedule': fallback_result['schedule'],
+                'emergency_outages': fallback_result['emergency_outages']
+            })
+            today_updated += 1
+    return today_updated, tomorrow_updated
+
+async def fetch_with_session(session, channel_list, today, tomorrow):
+    """Fetch a list of channels through one Telegram session with batch processing and delays"""
+    client = TelegramClient(session['session_path'], session['api_id'], session['api_hash'])
+    results = {}
+    try:
+        with registry.timer('fetcher_telegram_request_duration_seconds', method='start'):
+            await client.start()
+        
+        for batch_idx in range(0, len(channel_list), batch_size):
+            batch = channel_list[batch_idx:batch_idx + batch_size]
+            print(f"\n[{session['name']}] Processing batch {batch_idx // batch_size + 1}/{(len(channel_list) + batch_size - 1) // batch_size}")
+            print(f"Parsing up to {limit_messages} messages per channel")
+            
+            for channel in batch:
+                results[channel.get('id')] = await fetch_messages_for_channel(client, channel, today, tomorrow)
+            
+            if batch_idx + batch_size < len(channel_list):
+                print(f"Waiting {batch_delay} seconds before next batch...")
+                await asyncio.sleep(batch_delay)
+        return results
+    finally:
+        await client.disconnect()
+
+def run_shard(session, channel_list, today, tomorrow):
+    """Worker process entry point: fetch one shard, return results, its metrics and its profile file"""
+    global registry
+    # Pool workers are reused between tasks and would carry the previous
+    # shard's counters; start clean so the coordinator can add the shard's
+    # numbers without double counting
+    registry = metrics.Registry()
+
+    def fetch_shard():
+        try:
+            return asyncio.run(fetch_with_session(session, channel_list, today, tomorrow))
+        except Exception as e:
+            print(f"[ERR] Shard {session['name']} failed: {str(e)}")
+            return {channel.get('id'): None for channel in channel_list}
+
+    try:
+        # The shard does the fetching and parsing, so its profile is merged into the cycle's
+        results, profile_path = profiling.run_profiled_child(fetch_shard, profile_settings,
+                                                             f"shard_{session['name']}")
+    finally:
+        if parse_worker is not None:
+            parse_worker.close()
+    return results, registry.to_dict(), profile_path
+
+def load_shard_state():
+    try:
+        with open(shard_state_file, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+            return state if isinstance(state, dict) else {}
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+def save_shard_state(state):
+    with open(shard_state_file, 'w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False, indent=4)
+
+def assign_shards(channel_list, session_list, unavailable):
+    """Split channels between sessions: pinned channels first, the rest to the least loaded"""
+    available = [s for s in session_list if s['name'] not in unavailable] or session_list
+    names = {s['name'] for s in available}
+    shards = {s['name']: [] for s in available}
+    unpinned = []
+    for channel in channel_list:
+        if channel.get('session') in names:
+            shards[channel['session']].append(channel)
+        else:
+            unpinned.append(channel)
+    for channel in unpinned:
+        target = min(shards, key=lambda name: len(shards[name]))
+        shards[target].append(channel)
+    return {name: shard for name, shard in shards.items() if shard}
+
+async def fetch_sharded(today, tomorrow):
+    """Fetch every shard in its own worker process and rebalance rate-limited channels"""
+    by_name = {s['name']: s for s in sessions}
+    state = load_shard_state()
+    now = time.time()
+    rate_limited = {name: until for name, until in state.get('rate_limited_until', {}).items()
+                    if until > now and name in by_name}
+    
+    loop = asyncio.get_running_loop()
+    results = {}
+    pending = channels
+    ctx = multiprocessing.get_context('spawn')
+    for round_idx in range(2):
+        shards = assign_shards(pending, sessions, rate_limited)
+        print(f"\nShard round {round_idx + 1}: " + ', '.join(f'{name}={len(shard)}' for name, shard in shards.items()))
+        retry = []
+        # A fresh pool per round: a worker that died in round 1 leaves its
+        # pool broken, and the rebalanced shards must not inherit that
+        with concurrent.futures.ProcessPoolExecutor(max_workers=len(shards), mp_context=ctx) as pool:
+            futures = {}
+            for name, shard in shards.items():
+                try:
+                    futures[name] = loop.run_in_executor(pool, run_shard, by_name[name], shard, today, tomorrow)
+                except (concurrent.futures.BrokenExecutor, RuntimeError) as e:
+                    print(f"[ERR] Shard {name} could not be started: {str(e)}")
+                    futures[name] = None
+            for name, future in futures.items():
+                shard_results, shard_metrics = {c.get('id'): None for c in shards[name]}, None
+                if future is not None:
+                    try:
+                        shard_results, shard_metrics, shard_profile = await future
+                        profiling.add_child_profile(shard_profile)
+                    except Exception as e:
+                        print(f"[ERR] Shard {name} worker failed: {str(e)}")
+                registry.merge_dict(shard_metrics)
+                flood_waits = [r['flood_wait'] for r in shard_results.values() if r and r.get('flood_wait')]
+                if flood_waits:
+                    rate_limited[name] = time.time() + max(flood_waits)
+                    print(f"[SHARD] Session {name} rate-limited for {max(flood_waits)} seconds")
+                for channel in shards[name]:
+                    result = shard_results.get(channel.get('id'))
+                    if result and result.get('flood_wait'):
+                        retry.append(channel)
+                    else:
+                        results[channel.get('id')] = result
+        if not retry or all(s['name'] in rate_limited for s in sessions):
+            for channel in retry:
+                results.setdefault(channel.get('id'), None)
+            break
+        registry.inc('fetcher_shard_rebalances_total', len(retry))
+        pending = retry
+    
+    state['rate_limited_until'] = rate_limited
+    save_shard_state(state)
+    return results
 
 async def fetch_all_channels():
-    """Fetch schedules from all channels with batch processing and delays"""
-    client = TelegramClient(session_path, api_id, api_hash)
+    """Fetch schedules from all channels, sharded across sessions when several are configured"""
+    cycle_started = time.perf_counter()
+    success = False
     
     try:
-        await client.start()
-        
         tz = datetime.timezone(datetime.timedelta(hours=timezone_offset))
         today = str(datetime.datetime.now(tz).date())
         tomorrow = str(datetime.datetime.now(tz).date() + datetime.timedelta(days=1))
+        quarantine.prune()
+        
+        if len(sessions) > 1:
+            results = await fetch_sharded(today, tomorrow)
+        else:
+            results = await fetch_with_session(sessions[0], channels, today, tomorrow)
         
         today_data = []
         tomorrow_data = []
         all_history = {}
+        all_aggregates = {}
         
         try:
             with open(today_file, 'r', encoding='utf-8') as f:
@@ -451,16 +764,9 @@ async def fetch_all_channels():
         for channel in channels:
             channel_id = channel.get('id')
             history_file_path = history_file_template.format(channel_id)
-            try:
-                if os.path.exists(history_file_path):
-                    with open(history_file_path, 'r', encoding='utf-8') as f:
-                        all_history[channel_id] = json.load(f)
-                        if not isinstance(all_history[channel_id], list):
-                            all_history[channel_id] = []
-                else:
-                    all_history[channel_id] = []
-            except (json.JSONDecodeError, IOError):
-                all_history[channel_id] = []
+            all_history[channel_id], all_aggregates[channel_id] = history.load(history_file_path)
+        
+        previous_schedules = copy.deepcopy(today_data + tomorrow_data)
         
         rotated = False
         if today_data and today_data[0].get('schedule_date') != today:
@@ -471,85 +777,18 @@ async def fetch_all_channels():
         today_updated = 0
         tomorrow_updated = 0
         
-        for batch_idx in range(0, len(channels), batch_size):
-            batch = channels[batch_idx:batch_idx + batch_size]
-            print(f"\nProcessing batch {batch_idx // batch_size + 1}/{(len(channels) + batch_size - 1) // batch_size}")
-            print(f"Parsing up to {limit_messages} messages per channel")
-            
-            for channel in batch:
-                channel_id = channel.get('id')
-                
-                result = await fetch_messages_for_channel(client, channel, today, tomorrow)
-                
-                if result:
-                    today_result = result.get('today')
-                    tomorrow_result = result.get('tomorrow')
-                    fallback_result = result.get('fallback')
-                    # Update today data
-                    if today_result:
-                        schedule_date = today_result['schedule_date']
-                        today_idx = next((i for i, item in enumerate(today_data) if item.get('channel_id') == channel_id), -1)
-                        if today_idx != -1:
-                            existing = today_data[today_idx].get('schedule', {})
-                            for queue, new_periods in today_result['schedule'].items():
-                                old_periods = existing.get(queue, [])
-                                combined = old_periods + new_periods
-                                merged = merge_intervals(combined)
-                                existing[queue] = merged
-                            today_data[today_idx]['schedule_time'] = today_result['schedule_time']
-                            today_data[today_idx]['schedule_date'] = schedule_date
-                            today_data[today_idx]['emergency_outages'] = today_result['emergency_outages'] or today_data[today_idx].get('emergency_outages', False)
-                        else:
-                            today_data.append({
-                                'channel_id': channel_id,
-                                'schedule_date': schedule_date,
-                                'schedule_time': today_result['schedule_time'],
-                                'schedule': today_result['schedule'],
-                                'emergency_outages': today_result['emergency_outages']
-                            })
-                        today_updated += 1
-                    
-                    # Update tomorrow data
-                    if tomorrow_result:
-                        schedule_date = tomorrow_result['schedule_date']
-                        tomorrow_idx = next((i for i, item in enumerate(tomorrow_data) if item.get('channel_id') == channel_id), -1)
-                        if tomorrow_idx != -1:
-                            existing = tomorrow_data[tomorrow_idx].get('schedule', {})
-                            for queue, new_periods in tomorrow_result['schedule'].items():
-                                old_periods = existing.get(queue, [])
-                                combined = old_periods + new_periods
-                                merged = merge_intervals(combined)
-                                existing[queue] = merged
-                            tomorrow_data[tomorrow_idx]['schedule_time'] = tomorrow_result['schedule_time']
-                            tomorrow_data[tomorrow_idx]['schedule_date'] = schedule_date
-                            tomorrow_data[tomorrow_idx]['emergency_outages'] = tomorrow_result['emergency_outages'] or tomorrow_data[tomorrow_idx].get('emergency_outages', False)
-                        else:
-                            tomorrow_data.append({
-                                'channel_id': channel_id,
-                                'schedule_date': schedule_date,
-                                'schedule_time': tomorrow_result['schedule_time'],
-                                'schedule': tomorrow_result['schedule'],
-                                'emergency_outages': tomorrow_result['emergency_outages']
-                            })
-                        tomorrow_updated += 1
-                    
-                    if fallback_result and not today_result:
-                        fallback_result['schedule_date'] = today
-                        today_idx = next((i for i, item in enumerate(today_data) if item.get('channel_id') == channel_id), -1)
-                        if today_idx == -1:
-                            today_data.append({
-                                'channel_id': channel_id,
-                                'schedule_date': today,
-                                'schedule_time': fallback_result['schedule_time'],
-                                'schedule': fallback_result['schedule'],
-                                'emergency_outages': fallback_result['emergency_outages']
-                            })
-                            today_updated += 1
-            
-            if batch_idx + batch_size < len(channels):
-                print(f"Waiting {batch_delay} seconds before next batch...")
-                await asyncio.sleep(batch_delay)
+        for channel in channels:
+            channel_id = channel.get('id')
+            result = results.get(channel_id)
+            merge_started = time.perf_counter()
+            if result:
+                today_inc, tomorrow_inc = merge_channel_result(result, channel_id, today, today_data, tomorrow_data)
+                today_updated += today_inc
+                tomorrow_updated += tomorrow_inc
+            registry.observe('fetcher_phase_duration_seconds', time.perf_counter() - merge_started,
+                             phase='merge', channel=channel_id)
         
+        write_started = time.perf_counter()
         # Save today data
         with open(today_file, 'w', encoding='utf-8') as f:
             json.dump(today_data, f, ensure_ascii=False, indent=4)
@@ -561,12 +800,34 @@ async def fetch_all_channels():
         # Save individual history files
         for channel in channels:
             channel_id = channel.get('id')
-            history = all_history.get(channel_id, [])
-            history.sort(key=lambda x: x['schedule_date'], reverse=True)
-            
             history_file_path = history_file_template.format(channel_id)
-            with open(history_file_path, 'w', encoding='utf-8') as f:
-                json.dump(history, f, ensure_ascii=False, indent=4)
+            history.save(history_file_path, all_history.get(channel_id, []), all_aggregates.get(channel_id, []),
+                         channel_id, history_settings, today)
+            if history_settings['archive']:
+                # The JSON history is already saved; a failed archive only leaves the previous one in place
+                try:
+                    archive.build_from_history(history_file_path, channel_id)
+                except (ValueError, OSError) as e:
+                    registry.inc('fetcher_archive_failures_total')
+                    print(f'Archive build failed for channel {channel_id}: {str(e)}')
+        registry.observe('fetcher_phase_duration_seconds', time.perf_counter() - write_started, phase='write')
+        
+        # Hand changes over to the API's webhook dispatcher; delivery happens there
+        events = webhooks.diff_schedules(previous_schedules, today_data + tomorrow_data, today, tomorrow)
+        if webhooks.write_outbox(base, events):
+            print(f'Queued {len(events)} schedule change events for webhooks')
+        
+        # Pre-render the read-only API for nginx/CDN; a failed export keeps the previous version live
+        if export_settings['enabled']:
+            export_started = time.perf_counter()
+            try:
+                manifest = export.export_static(base, export_settings)
+                if manifest:
+                    print(f"Exported {manifest['documents']} API documents ({manifest['rendered']} rendered) to {manifest['version']}")
+            except Exception as e:
+                registry.inc('fetcher_export_failures_total')
+                print(f'Static export failed: {str(e)}')
+            registry.observe('fetcher_phase_duration_seconds', time.perf_counter() - export_started, phase='export')
         
         print(f'\n{"="*60}')
         print(f'Parsing complete!')
@@ -576,17 +837,25 @@ async def fetch_all_channels():
         print(f'Updated tomorrow schedules: {tomorrow_updated}/{len(channels)} channels')
         print(f'Saved to: {today_file}, {tomorrow_file} and history files')
         print(f'{"="*60}')
+        success = True
         return True
         
     except Exception as e:
         print(f'Error: {str(e)}')
         return False
     finally:
-        await client.disconnect()
+        registry.observe('fetcher_cycle_duration_seconds', time.perf_counter() - cycle_started)
+        registry.inc('fetcher_cycles_total', result='success' if success else 'error')
 
 if __name__ == '__main__':
+    # Counters are cumulative across cycles: start from the previous snapshot
+    registry.load(metrics_file)
     try:
-        asyncio.run(fetch_all_channels())
+        profiling.run_profiled(lambda: asyncio.run(fetch_all_channels()), profile_settings, 'fetch')
     except Exception as e:
         print(f'Fatal error: {str(e)}')
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(1)
+    finally:
+        if parse_worker is not None:
+            parse_worker.close()
+        registry.save(metrics_file)
\ No newline at end of file
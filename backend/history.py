@@ -0,0 +1,221 @@
+"""Per-channel schedule history storage.
+
+Two layouts of schedule_history_{id}.json are understood:
+
+- legacy: a JSON list of day entries, one full schedule per day
+- compact: each distinct daily schedule is stored once under its hash and
+  day entries reference it; days older than the retention window are
+  folded into monthly aggregates
+
+load() always returns plain day entries, so callers never see the layout.
+
+Usage:
+    python history.py compact [--full-days N]
+"""
+import argparse
+import datetime
+import glob
+import hashlib
+import json
+import os
+
+FORMAT = 'compact'
+FORMAT_VERSION = 1
+
+
+def load_settings(cfg):
+    """Read the `history` config section"""
+    section = cfg.get('history', {})
+    return {
+        'compact': bool(section.get('compact', False)),
+        'full_days': section.get('full_days') or None,
+        'archive': bool(section.get('archive', False)),
+    }
+
+
+def schedule_hash(schedule):
+    canonical = json.dumps(schedule, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()[:16]
+
+
+def outage_minutes(periods):
+    """Total minutes covered by 'HH:MM-HH:MM' periods, '24:00'/'00:00' ends count as midnight"""
+    total = 0
+    for period in periods:
+        try:
+            start, end = period.split('-')
+            sh, sm = map(int, start.split(':'))
+            eh, em = map(int, end.split(':'))
+        except ValueError:
+            continue
+        s = sh * 60 + sm
+        e = eh * 60 + em
+        if e <= s:
+            e += 24 * 60
+        total += e - s
+    return total
+
+
+def files_version(paths):
+    """Cheap version stamp of a set of data files: changes whenever one is rewritten"""
+    version = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            version.append((path, st.st_mtime_ns, st.st_size))
+        except OSError:
+            version.append((path, None, None))
+    return tuple(version)
+
+
+def is_compact(doc):
+    return isinstance(doc, dict) and doc.get('format') == FORMAT
+
+
+def expand(doc):
+    """Turn a compact document back into legacy day entries"""
+    schedules = doc.get('schedules', {})
+    channel_id = doc.get('channel_id')
+    entries = []
+    for day in doc.get('days', []):
+        entries.append({
+            'channel_id': channel_id,
+            'schedule_date': day['schedule_date'],
+            'schedule_time': day.get('schedule_time', ''),
+            'schedule': schedules.get(day.get('schedule_ref'), {}),
+            'emergency_outages': day.get('emergency_outages', False),
+        })
+    return entries
+
+
+def compact(entries, aggregates, channel_id):
+    """Build a compact document from day entries and monthly aggregates"""
+    schedules = {}
+    days = []
+    for entry in entries:
+        schedule = entry.get('schedule', {})
+        ref = schedule_hash(schedule)
+        schedules.setdefault(ref, schedule)
+        days.append({
+            'schedule_date': entry['schedule_date'],
+            'schedule_time': entry.get('schedule_time', ''),
+            'schedule_ref': ref,
+            'emergency_outages': entry.get('emergency_outages', False),
+        })
+    return {
+        'format': FORMAT,
+        'version': FORMAT_VERSION,
+        'channel_id': channel_id,
+        'schedules': schedules,
+        'days': days,
+        'aggregates': aggregates,
+    }
+
+
+def read_document(path):
+    """Raw JSON content of a history file, None when it is missing or broken"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError, IOError):
+        return None
+
+
+def load(path):
+    """Return (entries, aggregates) from a history file of either layout"""
+    doc = read_document(path)
+    if is_compact(doc):
+        return expand(doc), doc.get('aggregates', [])
+    if isinstance(doc, list):
+        return doc, []
+    return [], []
+
+
+def find_day(path, date):
+    """Day entry for `date` in a history file, or None"""
+    doc = read_document(path)
+    if is_compact(doc):
+        for day in doc.get('days', []):
+            if day.get('schedule_date') == date:
+                return {
+                    'channel_id': doc.get('channel_id'),
+                    'schedule_date': date,
+                    'schedule_time': day.get('schedule_time', ''),
+                    'schedule': doc.get('schedules', {}).get(day.get('schedule_ref'), {}),
+                    'emergency_outages': day.get('emergency_outages', False),
+                }
+        return None
+    if isinstance(doc, list):
+        for item in doc:
+            if item.get('schedule_date') == date:
+                return item
+    return None
+
+
+def apply_retention(entries, aggregates, full_days, today):
+    """Fold day entries older than `full_days` into monthly aggregates"""
+    if not full_days:
+        return entries, aggregates
+    cutoff = str(datetime.date.fromisoformat(today) - datetime.timedelta(days=full_days))
+    by_month = {a['month']: a for a in aggregates}
+    kept = []
+    for entry in entries:
+        if entry['schedule_date'] >= cutoff:
+            kept.append(entry)
+            continue
+        month = entry['schedule_date'][:7]
+        agg = by_month.get(month)
+        if agg is None:
+            agg = by_month[month] = {'month': month, 'days': 0, 'emergency_days': 0, 'outage_hours': {}}
+        agg['days'] += 1
+        if entry.get('emergency_outages'):
+            agg['emergency_days'] += 1
+        for queue, periods in entry.get('schedule', {}).items():
+            hours = agg['outage_hours'].get(queue, 0) + outage_minutes(periods) / 60
+            agg['outage_hours'][queue] = round(hours, 2)
+    return kept, sorted(by_month.values(), key=lambda a: a['month'], reverse=True)
+
+
+def save(path, entries, aggregates, channel_id, settings, today):
+    """Write history in the configured layout, newest day first"""
+    entries = sorted(entries, key=lambda x: x['schedule_date'], reverse=True)
+    tmp_path = f'{path}.tmp'
+    if settings['compact']:
+        entries, aggregates = apply_retention(entries, aggregates, settings['full_days'], today)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(compact(entries, aggregates, channel_id), f, ensure_ascii=False, separators=(',', ':'))
+    else:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entries, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+    return entries
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Schedule history maintenance')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('compact', help='rewrite all history files in the compact layout')
+    run.add_argument('--full-days', type=int, help='keep full detail for this many days (overrides config)')
+    args = parser.parse_args(argv)
+
+    base = os.path.dirname(os.path.abspath(__file__))
+    cfg = read_document(os.path.join(base, 'config.json')) or {}
+    settings = load_settings(cfg)
+    settings['compact'] = True
+    if args.full_days is not None:
+        settings['full_days'] = args.full_days or None
+    today = str(datetime.date.today())
+
+    for path in sorted(glob.glob(os.path.join(base, 'schedule_history_*.json'))):
+        try:
+            channel_id = int(os.path.basename(path)[len('schedule_history_'):-len('.json')])
+        except ValueError:
+            continue
+        before = os.path.getsize(path)
+        entries, aggregates = load(path)
+        kept = save(path, entries, aggregates, channel_id, settings, today)
+        print(f'{os.path.basename(path)}: {before} -> {os.path.getsize(path)} bytes, {len(kept)} days kept')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,208 @@
+"""iCalendar (RFC 5545) feeds of outage periods per channel and queue.
+
+Periods are taken from recent history, today and tomorrow. A period that
+ends at or before its start ("21:30-00:00", "22:00-02:00") ends on the
+next day, and periods that touch across midnight are joined into one
+event. Each feed is rendered once per data version and served with an
+ETag, so polling calendar clients mostly get 304 responses.
+
+Periods are wall-clock times in the configured IANA zone (Europe/Kyiv by
+default), so DST is applied per date before events are written in UTC.
+"""
+import datetime
+import hashlib
+import os
+import threading
+import zoneinfo
+
+import history
+
+PRODID = '-//GPV API//Outage schedule//UK'
+FEED_LOCKS = 16
+
+
+def load_settings(cfg):
+    """Read the `calendar` config section"""
+    section = cfg.get('calendar', {})
+    return {
+        'history_days': int(section.get('history_days', 14)),
+        'max_age': int(section.get('max_age', 300)),
+        'timezone': section.get('timezone', 'Europe/Kyiv'),
+    }
+
+
+def load_timezone(name, fallback_offset):
+    """ZoneInfo for `name`; a fixed UTC offset when tz data is not available"""
+    try:
+        return zoneinfo.ZoneInfo(name)
+    except (zoneinfo.ZoneInfoNotFoundError, ValueError):
+        print(f"Timezone {name} not found, falling back to UTC{fallback_offset:+g}")
+        return datetime.timezone(datetime.timedelta(hours=fallback_offset))
+
+
+def _escape(text):
+    return (text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Split a content line into 75-octet chunks as RFC 5545 requires"""
+    data = line.encode('utf-8')
+    if len(data) <= 75:
+        return line
+    parts = []
+    limit = 75
+    while data:
+        cut = min(limit, len(data))
+        # Never split a UTF-8 sequence
+        while cut < len(data) and (data[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(data[:cut].decode('utf-8'))
+        data = data[cut:]
+        limit = 74
+    return '\r\n '.join(parts)
+
+
+def _utc(dt):
+    return dt.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+
+
+def period_range(date, period, tz):
+    """Aware (start, end) datetimes of 'HH:MM-HH:MM' on `date`, ends past midnight roll over.
+
+    Arithmetic is on wall-clock time, so each bound gets the UTC offset in
+    effect at that moment of that date.
+    """
+    try:
+        start, end = period.split('-')
+        sh, sm = map(int, start.split(':'))
+        eh, em = map(int, end.split(':'))
+    except ValueError:
+        return None
+    day = datetime.datetime.combine(datetime.date.fromisoformat(date), datetime.time(), tz)
+    start_dt = day + datetime.timedelta(hours=sh, minutes=sm)
+    end_dt = day + datetime.timedelta(hours=eh, minutes=em)
+    if end_dt <= start_dt:
+        end_dt += datetime.timedelta(days=1)
+    return start_dt, end_dt
+
+
+def build_events(entries, queue, tz):
+    """Merged (start, end, entry) outage intervals of one queue, sorted by start"""
+    intervals = []
+    for entry in entries:
+        for period in entry.get('schedule', {}).get(queue, []):
+            bounds = period_range(entry['schedule_date'], period, tz)
+            if bounds:
+                intervals.append((bounds[0], bounds[1], entry))
+    intervals.sort(key=lambda x: x[0])
+    merged = []
+    for start, end, entry in intervals:
+        if merged and start <= merged[-1][1]:
+            last_start, last_end, last_entry = merged[-1]
+            merged[-1] = (last_start, max(last_end, end), last_entry)
+        else:
+            merged.append((start, end, entry))
+    return merged
+
+
+def render_calendar(channel_id, city_name, queue, events, tz):
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        f'PRODID:{PRODID}',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{_escape(f"ГПВ {city_name}, черга {queue}")}',
+        'X-PUBLISHED-TTL:PT15M',
+    ]
+    if getattr(tz, 'key', None):
+        lines.append(f'X-WR-TIMEZONE:{tz.key}')
+    for start, end, entry in events:
+        published = entry.get('schedule_time') or '00:00:00'
+        try:
+            stamp = datetime.datetime.combine(datetime.date.fromisoformat(entry['schedule_date']),
+                                              datetime.time.fromisoformat(published), tz)
+        except ValueError:
+            stamp = start
+        description = 'Графік погодинних відключень'
+        if entry.get('emergency_outages'):
+            description += '. Діють графіки аварійних відключень'
+        lines += [
+            'BEGIN:VEVENT',
+            f'UID:{channel_id}-{queue}-{start.strftime("%Y%m%dT%H%M")}@gpv-api',
+            f'DTSTAMP:{_utc(stamp)}',
+            f'DTSTART:{_utc(start)}',
+            f'DTEND:{_utc(end)}',
+            f'SUMMARY:{_escape(f"Відключення світла, черга {queue}")}',
+            f'DESCRIPTION:{_escape(description)}',
+            'TRANSP:OPAQUE',
+            'END:VEVENT',
+        ]
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
+
+
+class CalendarFeeds:
+    """Rendered feeds cached per (channel, queue) until the data files change"""
+
+    def __init__(self, base, timezone_offset, settings):
+        self.base = base
+        self.tz = load_timezone(settings['timezone'], timezone_offset)
+        self.settings = settings
+        self._cache = {}
+        # Striped: feeds of different keys render in parallel, one key renders once
+        self._feed_locks = [threading.Lock() for _ in range(FEED_LOCKS)]
+
+    def _feed_lock(self, key):
+        return self._feed_locks[hash(key) % len(self._feed_locks)]
+
+    def _paths(self, channel_id):
+        return [
+            os.path.join(self.base, f'schedule_history_{channel_id}.json'),
+            os.path.join(self.base, 'schedule_today.json'),
+            os.path.join(self.base, 'schedule_tomorrow.json'),
+            os.path.join(self.base, 'cities.json'),
+        ]
+
+    def _entries(self, channel_id):
+        history_path, today_path, tomorrow_path, _ = self._paths(channel_id)
+        today = datetime.datetime.now(self.tz).date()
+        cutoff = str(today - datetime.timedelta(days=self.settings['history_days']))
+        by_date = {}
+        entries, _aggregates = history.load(history_path)
+        for entry in entries:
+            if entry.get('schedule_date', '') >= cutoff:
+                by_date[entry['schedule_date']] = entry
+        for path in (today_path, tomorrow_path):
+            doc = history.read_document(path)
+            if isinstance(doc, list):
+                for item in doc:
+                    if item.get('channel_id') == channel_id and item.get('schedule_date'):
+                        by_date[item['schedule_date']] = item
+        return list(by_date.values())
+
+    def _city_name(self, channel_id):
+        doc = history.read_document(self._paths(channel_id)[3]) or {}
+        for city in doc.get('cities', []):
+            if city['id'] == channel_id:
+                return city['name']
+        return 'Невідоме місто'
+
+    def feed(self, channel_id, queue):
+        """(body, etag) of a feed, or None when the queue has no data at all"""
+        version = history.files_version(self._paths(channel_id))
+        key = (channel_id, queue)
+        with self._feed_lock(key):
+            cached = self._cache.get(key)
+            if cached and cached[0] == version:
+                return cached[1], cached[2]
+
+            entries = self._entries(channel_id)
+            if not any(queue in entry.get('schedule', {}) for entry in entries):
+                return None
+            events = build_events(entries, queue, self.tz)
+            body = render_calendar(channel_id, self._city_name(channel_id), queue, events, self.tz)
+            etag = hashlib.sha1(body.encode('utf-8')).hexdigest()
+            self._cache[key] = (version, body, etag)
+            return body, etag
@@ -0,0 +1,162 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def _labels_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key, extra=None):
+    items = list(key)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    parts = []
+    for k, v in items:
+        v = v.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+        parts.append(f'{k}="{v}"')
+    return '{' + ','.join(parts) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Registry:
+    """Thread-safe in-process store of counters and histograms.
+
+    Metrics are keyed by name and a set of labels. The registry can be saved
+    to / loaded from a JSON snapshot so that the fetcher subprocess can hand
+    its numbers over to the API process, which renders them on /metrics.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = _labels_key(labels)
+        with self._lock:
+            series = self._histograms.setdefault(name, {})
+            hist = series.get(key)
+            if hist is None:
+                hist = series[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist['buckets'][i] += 1
+            hist['sum'] += value
+            hist['count'] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe the wall time of the wrapped block into histogram `name`"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'buckets': list(self.buckets),
+                'help': dict(self._help),
+                'counters': {
+                    name: [[dict(key), value] for key, value in series.items()]
+                    for name, series in self._counters.items()
+                },
+                'histograms': {
+                    name: [[dict(key), {'buckets': list(h['buckets']), 'sum': h['sum'], 'count': h['count']}]
+                           for key, h in series.items()]
+                    for name, series in self._histograms.items()
+                },
+            }
+
+    def merge_dict(self, data):
+        """Add the values of a snapshot produced by to_dict() to this registry"""
+        if not data:
+            return
+        same_buckets = tuple(data.get('buckets', ())) == self.buckets
+        with self._lock:
+            self._help.update(data.get('help', {}))
+            for name, series in data.get('counters', {}).items():
+                target = self._counters.setdefault(name, {})
+                for labels, value in series:
+                    key = _labels_key(labels)
+                    target[key] = target.get(key, 0) + value
+            if not same_buckets:
+                return
+            for name, series in data.get('histograms', {}).items():
+                target = self._histograms.setdefault(name, {})
+                for labels, h in series:
+                    key = _labels_key(labels)
+                    hist = target.get(key)
+                    if hist is None:
+                        hist = target[key] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+                    hist['buckets'] = [a + b for a, b in zip(hist['buckets'], h['buckets'])]
+                    hist['sum'] += h['sum']
+                    hist['count'] += h['count']
+
+    def load(self, path):
+        """Merge a JSON snapshot from disk, ignoring missing or broken files"""
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                self.merge_dict(json.load(f))
+        except (FileNotFoundError, json.JSONDecodeError, ValueError, KeyError, TypeError):
+            pass
+
+    def save(self, path):
+        """Atomically write the registry to a JSON snapshot"""
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def render(self):
+        """Render all metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name in sorted(self._counters):
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} counter')
+                for key, value in sorted(self._counters[name].items()):
+                    lines.append(f'{name}{_format_labels(key)} {_format_value(value)}')
+            for name in sorted(self._histograms):
+                if name in self._help:
+                    lines.append(f'# HELP {name} {self._help[name]}')
+                lines.append(f'# TYPE {name} histogram')
+                for key, h in sorted(self._histograms[name].items()):
+                    for bound, count in zip(self.buckets, h['buckets']):
+                        lines.append(f'{name}_bucket{_format_labels(key, ("le", _format_value(bound)))} {count}')
+                    lines.append(f'{name}_bucket{_format_labels(key, ("le", "+Inf"))} {h["count"]}')
+                    lines.append(f'{name}_sum{_format_labels(key)} {_format_value(h["sum"])}')
+                    lines.append(f'{name}_count{_format_labels(key)} {h["count"]}')
+        return '\n'.join(lines) + '\n' if lines else ''
+
+
+def render_all(*registries):
+    """Concatenate the exposition text of several registries"""
+    return ''.join(r.render() for r in registries)
@@ -0,0 +1,171 @@
+"""Guarded execution of the schedule parser.
+
+Channel posts are parsed in a persistent worker process. A call that
+exceeds its time budget kills the worker (a runaway regex cannot be
+interrupted inside the same interpreter), a fresh worker is started for
+the next message, and the offending message is quarantined so later
+cycles skip it instead of stalling on it again.
+
+Quarantine entries live in parse_quarantine/ as one small file per
+message, so shard worker processes can add entries without coordinating.
+"""
+import datetime
+import glob
+import json
+import multiprocessing
+import os
+import threading
+import time
+
+STARTUP_TIMEOUT = 60
+
+
+def load_settings(cfg):
+    """Read the `parser` config section"""
+    section = cfg.get('parser', {})
+    return {
+        'max_message_chars': int(section.get('max_message_chars', 4096)),
+        'timeout': float(section.get('timeout', 2.0)),
+        'quarantine_days': int(section.get('quarantine_days', 30)),
+    }
+
+
+class GuardTripped(Exception):
+    """The parser ran out of time or its worker died"""
+
+    def __init__(self, reason, seconds):
+        super().__init__(f'{reason} after {seconds:.2f}s')
+        self.reason = reason
+        self.seconds = seconds
+
+
+def _serve(conn, func):
+    conn.send(('ready', None))
+    while True:
+        try:
+            arg = conn.recv()
+        except (EOFError, OSError):
+            return
+        try:
+            conn.send(('ok', func(arg)))
+        except Exception as e:
+            conn.send(('error', repr(e)))
+
+
+class GuardedWorker:
+    """Call `func` in a child process with a per-call timeout"""
+
+    def __init__(self, func, timeout):
+        self.func = func
+        self.timeout = timeout
+        self._ctx = multiprocessing.get_context('spawn')
+        self._process = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _start(self):
+        parent_conn, child_conn = self._ctx.Pipe()
+        self._process = self._ctx.Process(target=_serve, args=(child_conn, self.func), daemon=True)
+        self._process.start()
+        child_conn.close()
+        self._conn = parent_conn
+        # Interpreter start-up and imports are not charged to the first message
+        try:
+            ready = parent_conn.poll(STARTUP_TIMEOUT) and parent_conn.recv() == ('ready', None)
+        except (EOFError, OSError):
+            ready = False
+        if not ready:
+            self._kill()
+            raise RuntimeError('parser worker failed to start')
+
+    def _kill(self):
+        if self._process is not None:
+            self._process.kill()
+            self._process.join()
+            self._conn.close()
+        self._process = None
+        self._conn = None
+
+    def call(self, arg):
+        """Result of func(arg); raises GuardTripped on timeout or a dead worker,
+        RuntimeError when no worker can be started"""
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._kill()
+                self._start()
+            started = time.perf_counter()
+            try:
+                self._conn.send(arg)
+                ready = self._conn.poll(self.timeout)
+                if ready:
+                    status, value = self._conn.recv()
+            except (EOFError, OSError):
+                self._kill()
+                raise GuardTripped('crash', time.perf_counter() - started)
+            if not ready:
+                self._kill()
+                raise GuardTripped('timeout', time.perf_counter() - started)
+            if status == 'error':
+                raise GuardTripped('error', time.perf_counter() - started)
+            return value
+
+    def close(self):
+        with self._lock:
+            self._kill()
+
+
+class Quarantine:
+    """Messages that tripped the guard, keyed by (channel_id, message_id)"""
+
+    def __init__(self, directory, keep_days):
+        self.directory = directory
+        self.keep_days = keep_days
+        self._keys = None
+
+    def _path(self, channel_id, message_id):
+        return os.path.join(self.directory, f'{channel_id}_{message_id}.json')
+
+    def _load(self):
+        keys = set()
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                channel_id, message_id = os.path.basename(path)[:-len('.json')].split('_')
+                keys.add((int(channel_id), int(message_id)))
+            except ValueError:
+                continue
+        return keys
+
+    def __contains__(self, key):
+        if self._keys is None:
+            self._keys = self._load()
+        return key in self._keys
+
+    def add(self, channel_id, message_id, reason, chars, seconds):
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(channel_id, message_id)
+        with open(f'{path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump({
+                'channel_id': channel_id,
+                'message_id': message_id,
+                'reason': reason,
+                'chars': chars,
+                'seconds': round(seconds, 3),
+                'quarantined_at': datetime.datetime.now().isoformat(),
+            }, f, ensure_ascii=False, indent=4)
+        os.replace(f'{path}.tmp', path)
+        if self._keys is not None:
+            self._keys.add((channel_id, message_id))
+
+    def prune(self):
+        """Forget entries older than keep_days, return how many were removed"""
+        cutoff = time.time() - self.keep_days * 86400
+        removed = 0
+        for path in glob.glob(os.path.join(self.directory, '*.json')):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                continue
+        self._keys = None
+        return removed
@@ -0,0 +1,210 @@
+import cProfile
+import datetime
+import glob
+import json
+import os
+import pstats
+import random
+import re
+import threading
+import time
+
+ENV_FLAG = 'GPV_PROFILE'
+
+
+def load_settings(cfg, base):
+    """Read the `profiling` config section; GPV_PROFILE=1 turns profiling on too"""
+    section = cfg.get('profiling', {})
+    env = os.environ.get(ENV_FLAG, '').strip().lower()
+    if env:
+        enabled = env in ('1', 'true', 'yes', 'on')
+    else:
+        enabled = bool(section.get('enabled', False))
+    return {
+        'enabled': enabled,
+        'output_dir': os.path.join(base, section.get('output_dir', 'profiles')),
+        'request_sample_rate': float(section.get('request_sample_rate', 0.01)),
+        'top_n': int(section.get('top_n', 15)),
+        'keep_files': int(section.get('keep_files', 50)),
+    }
+
+
+def top_functions(stats, limit):
+    """Return the `limit` functions with the highest own time from a pstats.Stats"""
+    rows = []
+    for (filename, line, func), (cc, nc, tt, ct, _callers) in stats.stats.items():
+        rows.append({
+            'function': f'{os.path.basename(filename)}:{line}({func})',
+            'calls': nc,
+            'tottime': round(tt, 6),
+            'cumtime': round(ct, 6),
+        })
+    rows.sort(key=lambda r: r['tottime'], reverse=True)
+    return rows[:limit]
+
+
+STAMP = re.compile(r'\d{8}_\d{6}_\d{6}')
+# Profiles dumped by worker processes, merged into this process's next write_stats
+_child_profiles = []
+
+
+def _prune(output_dir, prefix, keep):
+    # `request_get_schedules_*` would also match the today/tomorrow profiles,
+    # so only names where the rest after the prefix is exactly a timestamp count
+    files = sorted(
+        path for path in glob.glob(os.path.join(output_dir, f'{prefix}_[0-9]*.prof'))
+        if STAMP.fullmatch(os.path.basename(path)[len(prefix) + 1:-len('.prof')])
+    )
+    for path in files[:-keep] if keep > 0 else files:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def write_stats(profiler, settings, prefix, elapsed):
+    """Dump a finished profile to `<prefix>_<timestamp>.prof` plus a JSON summary"""
+    output_dir = settings['output_dir']
+    os.makedirs(output_dir, exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    prof_path = os.path.join(output_dir, f'{prefix}_{stamp}.prof')
+    stats = pstats.Stats(profiler)
+    merged = 0
+    while _child_profiles:
+        child_path = _child_profiles.pop()
+        try:
+            stats.add(child_path)
+            merged += 1
+        except (OSError, EOFError, ValueError, TypeError) as e:
+            print(f'Cannot merge profile {child_path}: {e}')
+        finally:
+            try:
+                os.remove(child_path)
+            except OSError:
+                pass
+    stats.dump_stats(prof_path)
+
+    summary = {
+        'timestamp': datetime.datetime.now().isoformat(),
+        'elapsed_seconds': round(elapsed, 3),
+        'stats_file': os.path.basename(prof_path),
+        'merged_processes': merged,
+        'top_functions': top_functions(stats, settings['top_n']),
+    }
+    summary_path = os.path.join(output_dir, f'{prefix}_latest.json')
+    tmp_path = f'{summary_path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(summary, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, summary_path)
+    _prune(output_dir, prefix, settings['keep_files'])
+    return summary
+
+
+def load_summary(settings, prefix):
+    path = os.path.join(settings['output_dir'], f'{prefix}_latest.json')
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
+def run_profiled(func, settings, prefix):
+    """Call `func()` under cProfile when profiling is enabled, plain call otherwise"""
+    if not settings['enabled']:
+        return func()
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    profiler.enable()
+    try:
+        return func()
+    finally:
+        profiler.disable()
+        write_stats(profiler, settings, prefix, time.perf_counter() - started)
+
+
+def run_profiled_child(func, settings, name):
+    """(func(), profile path) in a worker process; the path is None when profiling is off.
+
+    The coordinator hands the path to add_child_profile so the worker's
+    functions show up in its own profile instead of a separate file.
+    """
+    if not settings['enabled']:
+        return func(), None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        result = func()
+    finally:
+        profiler.disable()
+    os.makedirs(settings['output_dir'], exist_ok=True)
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')
+    path = os.path.join(settings['output_dir'], f'.child_{name}_{os.getpid()}_{stamp}.prof')
+    profiler.dump_stats(path)
+    return result, path
+
+
+def add_child_profile(path):
+    if path:
+        _child_profiles.append(path)
+
+
+class RequestProfiler:
+    """Profile a random sample of Flask requests.
+
+    Hooks are registered only by install(), so an app without profiling
+    enabled pays nothing per request. cProfile allows a single active
+    profiler per process, so concurrent requests are never sampled together.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.sampled = 0
+        self._stats = None
+        self._lock = threading.Lock()
+        self._active = threading.Lock()
+
+    def install(self, app):
+        from flask import g, request
+
+        rate = self.settings['request_sample_rate']
+
+        @app.before_request
+        def start_profile():
+            if random.random() < rate and self._active.acquire(blocking=False):
+                g.profiler = cProfile.Profile()
+                g.profile_started = time.perf_counter()
+                g.profiler.enable()
+
+        @app.after_request
+        def stop_profile(response):
+            profiler = g.pop('profiler', None)
+            if profiler is not None:
+                profiler.disable()
+                self._active.release()
+                elapsed = time.perf_counter() - g.pop('profile_started')
+                endpoint = request.url_rule.endpoint if request.url_rule else 'unmatched'
+                write_stats(profiler, self.settings, f'request_{endpoint}', elapsed)
+                with self._lock:
+                    self.sampled += 1
+                    if self._stats is None:
+                        self._stats = pstats.Stats(profiler)
+                    else:
+                        self._stats.add(profiler)
+            return response
+
+        @app.teardown_request
+        def abort_profile(_exc):
+            profiler = g.pop('profiler', None)
+            if profiler is not None:
+                profiler.disable()
+                self._active.release()
+
+    def summary(self):
+        with self._lock:
+            if self._stats is None:
+                return {'sampled': 0, 'top_functions': []}
+            return {
+                'sampled': self.sampled,
+                'top_functions': top_functions(self._stats, self.settings['top_n']),
+            }
@@ -0,0 +1,203 @@
+"""Shared in-memory view of the schedule files and the schedule responses.
+
+Files are decoded once and kept in memory until their mtime/size
+changes, so serving a request is a dict lookup instead of a file read.
+The response builders below are the only implementation of the schedule
+endpoints: app.py, asgi.py and the static export all call them, and
+dumps() matches Flask's jsonify, so every server returns identical bodies.
+
+In background mode (ASGI) a reader never loads a file or waits for a
+lock: a changed file is reloaded by a thread while the previous value is
+still served, and a value that was never loaded raises NotLoaded so the
+caller can load it off the event loop and retry.
+"""
+import collections
+import datetime
+import json
+import os
+import threading
+
+import archive
+import history
+
+KEY_LOCKS = 16
+
+
+class NotLoaded(Exception):
+    """A value has no cached copy yet; call `load()` (off the event loop) and retry"""
+
+    def __init__(self, load):
+        super().__init__('value is not loaded yet')
+        self.load = load
+
+
+def dumps(data):
+    """Serialize like Flask's default JSON provider outside debug mode"""
+    return json.dumps(data, ensure_ascii=True, sort_keys=True, separators=(',', ':')) + '\n'
+
+
+class ScheduleStore:
+    def __init__(self, base, use_archive=False, background=False, max_entries=1024):
+        self.base = base
+        self.use_archive = use_archive
+        self.background = background
+        self.max_entries = max_entries
+        # Keys are bounded by max_entries: least recently loaded values go first
+        self._cache = collections.OrderedDict()
+        self._key_locks = [threading.Lock() for _ in range(KEY_LOCKS)]
+        self._reloading = {}
+        self._local = threading.local()
+
+    def _path(self, name):
+        return os.path.join(self.base, name)
+
+    def _load(self, key, path, loader):
+        with self._key_locks[hash(key) % len(self._key_locks)]:
+            version = history.files_version([path])
+            cached = self._cache.get(key)
+            if cached and cached[0] == version:
+                return cached[1]
+            value = loader(path)
+            self._cache[key] = (version, value)
+            while len(self._cache) > self.max_entries:
+                try:
+                    self._cache.popitem(last=False)
+                except KeyError:
+                    break
+            return value
+
+    def _reload(self, key, path, loader, token):
+        try:
+            self._load(key, path, loader)
+        except Exception as e:
+            print(f'Cannot reload {path}: {e}')
+        finally:
+            if self._reloading.get(key) is token:
+                del self._reloading[key]
+
+    def _revalidate(self, key, path, loader):
+        token = object()
+        # setdefault is atomic, so only one reload per key is started
+        if self._reloading.setdefault(key, token) is not token:
+            return
+        threading.Thread(target=self._reload, args=(key, path, loader, token),
+                         name=f'store-reload-{key}', daemon=True).start()
+
+    def _cached(self, key, path, loader):
+        version = history.files_version([path])
+        cached = self._cache.get(key)
+        if cached and cached[0] == version:
+            return cached[1]
+        if not self.background or getattr(self._local, 'blocking', False):
+            return self._load(key, path, loader)
+        if cached:
+            self._revalidate(key, path, loader)
+            return cached[1]
+        raise NotLoaded(lambda: self._load(key, path, loader))
+
+    def cities(self):
+        """Parsed cities.json, None when the file is missing"""
+        def load(path):
+            if not os.path.exists(path):
+                return None
+            return history.read_document(path) or {}
+        return self._cached('cities', self._path('cities.json'), load)
+
+    def city_name(self, channel_id):
+        for city in (self.cities() or {}).get('cities', []):
+            if city['id'] == channel_id:
+                return city['name']
+        return None
+
+    def day_items(self, kind):
+        """Today or tomorrow entries keyed by channel id (first entry wins, like app.py)"""
+        def load(path):
+            doc = history.read_document(path)
+            items = {}
+            if isinstance(doc, list):
+                for item in doc:
+                    items.setdefault(item.get('channel_id'), item)
+            return items
+        return self._cached(kind, self._path(f'schedule_{kind}.json'), load)
+
+    def channel_history(self, channel_id):
+        """History entries of a channel keyed by date"""
+        def load(path):
+            entries, _aggregates = history.load(path)
+            by_date = {}
+            for entry in entries:
+                by_date.setdefault(entry.get('schedule_date'), entry)
+            return by_date
+        return self._cached(('history', channel_id), self._path(f'schedule_history_{channel_id}.json'), load)
+
+    def channel_archive(self, channel_id):
+        """Mapped archive of a channel, None when it has none"""
+        return self._cached(('archive', channel_id), self._path(f'schedule_history_{channel_id}.gpva'),
+                            archive.open_archive)
+
+    def history_day(self, channel_id, date):
+        # The mapped archive answers single-day lookups without decoding the whole history
+        channel_archive = self.channel_archive(channel_id) if self.use_archive else None
+        if channel_archive is not None:
+            return channel_archive.find_day(date)
+        return self.channel_history(channel_id).get(date)
+
+    def refresh(self):
+        """Load every file now, e.g. right after a fetch cycle (blocks; run it in a thread)"""
+        self._local.blocking = True
+        try:
+            self.cities()
+            self.day_items('today')
+            self.day_items('tomorrow')
+            for city in (self.cities() or {}).get('cities', []):
+                if self.use_archive:
+                    self.channel_archive(city['id'])
+                else:
+                    self.channel_history(city['id'])
+        finally:
+            self._local.blocking = False
+
+
+def schedule_payload(channel_id, city_name, date, item, queue, not_found):
+    """(body, status) of a schedule response, same rules as the Flask handlers"""
+    schedule_data = item.get('schedule', {}) if item else None
+    if not schedule_data:
+        return {"error": not_found}, 404
+
+    if queue:
+        if queue in schedule_data:
+            filtered_schedule = {queue: schedule_data[queue]}
+        else:
+            return {"error": f"Черга {queue} не знайдена"}, 404
+    else:
+        filtered_schedule = schedule_data
+
+    return {
+        "channel_id": channel_id,
+        "city_name": city_name or "Невідоме місто",
+        "date": date,
+        "time": item.get('schedule_time', ''),
+        "schedule": filtered_schedule,
+        "emergency_outages": item.get('emergency_outages', False)
+    }, 200
+
+
+def history_response(store, channel_id, date, queue):
+    if not channel_id or not date:
+        return {"error": "channel_id та date параметри обов'язкові"}, 400
+    item = store.history_day(channel_id, date)
+    return schedule_payload(channel_id, store.city_name(channel_id) if item else None, date, item, queue,
+                            f"Розклад на {date} не знайдено")
+
+
+def day_response(store, kind, channel_id, queue):
+    """Response of /api/schedules/today or /api/schedules/tomorrow"""
+    if not channel_id:
+        return {"error": "channel_id параметр обов'язковий"}, 400
+    item = store.day_items(kind).get(channel_id)
+    default_date = datetime.datetime.now()
+    if kind == 'tomorrow':
+        default_date += datetime.timedelta(days=1)
+    date = item.get('schedule_date', default_date.strftime("%Y-%m-%d")) if item else None
+    not_found = "Розклад на сьогодні не знайдено" if kind == 'today' else "Розклад на завтра не знайдено"
+    return schedule_payload(channel_id, store.city_name(channel_id) if item else None, date, item, queue, not_found)
@@ -0,0 +1,108 @@
+"""Request coalescing and per-client rate limiting for the API.
+
+SingleFlight lets concurrent identical requests share one computation:
+the first caller runs it, the others wait for its result. Nothing is
+cached afterwards, so a request that starts later reads fresh data.
+
+TokenBucketLimiter keeps one bucket per client: `burst` tokens refilled
+at `rate` per second. A request that finds the bucket empty is told how
+long to wait, which the API returns as 429 with Retry-After.
+"""
+import collections
+import math
+import threading
+import time
+
+
+def load_settings(cfg):
+    """Read the `rate_limit` config section"""
+    section = cfg.get('rate_limit', {})
+    return {
+        'enabled': bool(section.get('enabled', False)),
+        'rate': float(section.get('rate', 5)),
+        'burst': float(section.get('burst', 20)),
+        'update_per_minute': float(section.get('update_per_minute', 2)),
+        'update_burst': float(section.get('update_burst', 2)),
+        'trusted_proxies': int(section.get('trusted_proxies', 0)),
+        'max_clients': int(section.get('max_clients', 100000)),
+    }
+
+
+def client_address(remote_addr, forwarded_for, trusted_proxies):
+    """Client IP: with N trusted proxies in front, the Nth X-Forwarded-For hop from the right"""
+    if trusted_proxies and forwarded_for:
+        hops = [h.strip() for h in forwarded_for.split(',') if h.strip()]
+        if len(hops) >= trusted_proxies:
+            return hops[-trusted_proxies]
+    return remote_addr or 'unknown'
+
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, fn):
+        """(fn(), shared): shared is True when the result came from another caller's run"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class TokenBucketLimiter:
+    def __init__(self, rate, burst, max_clients=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def acquire(self, client, cost=1.0):
+        """0 when the request may proceed, otherwise seconds until it would"""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(client)
+            if bucket is None:
+                bucket = self._buckets[client] = [self.burst, now]
+                # Least recently seen clients go first; they come back with a full bucket
+                while len(self._buckets) > self.max_clients:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(client)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                return 0
+            return (cost - bucket[0]) / self.rate if self.rate > 0 else math.inf
+
+
+def retry_after_header(seconds):
+    """Retry-After value: whole seconds, at least 1"""
+    return str(max(1, math.ceil(min(seconds, 86400))))
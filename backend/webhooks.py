@@ -0,0 +1,429 @@
+"""Webhook subscriptions and batched delivery of schedule changes.
+
+The fetcher never talks to subscribers: it only diffs schedules and drops
+an outbox file per cycle. The API process runs WebhookDispatcher, which
+picks outbox files up, matches them against subscriptions from
+webhooks.json, batches events per endpoint and posts them from worker
+threads over pooled keep-alive connections, retrying with exponential
+backoff and moving exhausted deliveries to a dead-letter file.
+
+Usage (local receiver for testing deliveries):
+    python webhooks.py receive --port 8099
+"""
+import argparse
+import datetime
+import glob
+import heapq
+import hmac
+import http.client
+import http.server
+import ipaddress
+import itertools
+import json
+import os
+import random
+import socket
+import threading
+import time
+import urllib.parse
+import uuid
+
+MAX_DEAD_LETTERS = 1000
+
+
+def load_settings(cfg):
+    """Read the `webhooks` config section"""
+    section = cfg.get('webhooks', {})
+    return {
+        'workers': int(section.get('workers', 2)),
+        'batch_size': int(section.get('batch_size', 50)),
+        'max_retries': int(section.get('max_retries', 5)),
+        'backoff_seconds': float(section.get('backoff_seconds', 2)),
+        'max_backoff_seconds': float(section.get('max_backoff_seconds', 300)),
+        'timeout': float(section.get('timeout', 10)),
+        'poll_interval': float(section.get('poll_interval', 5)),
+        'admin_token': section.get('admin_token') or None,
+        'max_subscriptions': int(section.get('max_subscriptions', 100)),
+        'allowed_hosts': [h.lower() for h in section.get('allowed_hosts') or []],
+        'allow_private': bool(section.get('allow_private', False)),
+    }
+
+
+def authorized(settings, header_value):
+    """True when `header_value` is "Bearer <admin_token>"; without a configured token nothing is"""
+    token = settings['admin_token']
+    if not token or not header_value:
+        return False
+    scheme, _, value = header_value.partition(' ')
+    return scheme.lower() == 'bearer' and hmac.compare_digest(value.strip().encode(), token.encode())
+
+
+def check_target(url, settings):
+    """Raise ValueError unless `url` is an http(s) URL the API may post to.
+
+    With `allowed_hosts` configured only those hosts pass. Otherwise every
+    address the host resolves to must be public: loopback, private,
+    link-local (cloud metadata), multicast and reserved ranges are refused
+    unless `allow_private` is set.
+    """
+    parts = urllib.parse.urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ValueError('url must be http(s) with a host')
+    host = parts.hostname.lower()
+    if settings['allowed_hosts']:
+        if host not in settings['allowed_hosts']:
+            raise ValueError(f'host {host} is not in allowed_hosts')
+        return
+    if settings['allow_private']:
+        return
+    try:
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        infos = socket.getaddrinfo(host, port, proto=socket.IPPROTO_TCP)
+    except (socket.gaierror, UnicodeError) as e:
+        raise ValueError(f'cannot resolve {host}: {e}')
+    for info in infos:
+        address = ipaddress.ip_address(info[4][0].split('%')[0])
+        if isinstance(address, ipaddress.IPv6Address) and address.ipv4_mapped:
+            address = address.ipv4_mapped
+        if not address.is_global or address.is_multicast:
+            raise ValueError(f'host {host} resolves to non-public address {address}')
+
+
+def subscriptions_path(base):
+    return os.path.join(base, 'webhooks.json')
+
+
+def outbox_dir(base):
+    return os.path.join(base, 'webhook_outbox')
+
+
+def dead_letter_path(base):
+    return os.path.join(base, 'webhook_dead_letter.json')
+
+
+def _read_json(path, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return default
+
+
+def _write_json(path, data):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, path)
+
+
+def load_subscriptions(base):
+    subs = _read_json(subscriptions_path(base), [])
+    return subs if isinstance(subs, list) else []
+
+
+def save_subscriptions(base, subs):
+    _write_json(subscriptions_path(base), subs)
+
+
+def load_dead_letters(base):
+    return _read_json(dead_letter_path(base), [])
+
+
+def _index(items):
+    index = {}
+    for item in items:
+        for queue, periods in item.get('schedule', {}).items():
+            index[(item.get('channel_id'), item.get('schedule_date'), queue)] = (
+                periods, item.get('emergency_outages', False))
+    return index
+
+
+def diff_schedules(before, after, today, tomorrow):
+    """Events for every (channel, date, queue) of today/tomorrow whose periods changed.
+
+    Dates that just rotated out of today/tomorrow are not reported as removals.
+    """
+    old = _index(before)
+    new = _index(after)
+    events = []
+    for key in sorted(set(old) | set(new), key=str):
+        old_periods, _ = old.get(key, ([], False))
+        new_periods, emergency = new.get(key, ([], False))
+        if old_periods == new_periods:
+            continue
+        channel_id, date, queue = key
+        if date not in (today, tomorrow):
+            continue
+        events.append({
+            'id': uuid.uuid4().hex,
+            'type': 'schedule.changed',
+            'channel_id': channel_id,
+            'queue': queue,
+            'date': date,
+            'day': 'today' if date == today else 'tomorrow',
+            'schedule': new_periods,
+            'previous': old_periods,
+            'emergency_outages': emergency,
+        })
+    return events
+
+
+def write_outbox(base, events):
+    """Drop a batch of change events for the dispatcher, skipped when nobody subscribed"""
+    if not events or not load_subscriptions(base):
+        return None
+    directory = outbox_dir(base)
+    os.makedirs(directory, exist_ok=True)
+    name = f"{datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')}.json"
+    path = os.path.join(directory, name)
+    tmp_path = os.path.join(directory, f'.{name}.tmp')
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(events, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return path
+
+
+def matches(subscription, event):
+    if subscription.get('channel_id') not in (None, event['channel_id']):
+        return False
+    return subscription.get('queue') in (None, event['queue'])
+
+
+class ConnectionPool:
+    """Idle keep-alive HTTP(S) connections per (scheme, host:port)"""
+
+    def __init__(self, timeout, max_idle_per_host=4):
+        self.timeout = timeout
+        self.max_idle_per_host = max_idle_per_host
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _new(self, scheme, netloc):
+        cls = http.client.HTTPSConnection if scheme == 'https' else http.client.HTTPConnection
+        return cls(netloc, timeout=self.timeout)
+
+    def post(self, url, body, headers):
+        """POST `body` and return the response status"""
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = urllib.parse.urlunsplit(('', '', parts.path or '/', parts.query, ''))
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            conn = idle.pop() if idle else None
+        reused = conn is not None
+        if conn is None:
+            conn = self._new(*key)
+        try:
+            conn.request('POST', path, body=body, headers=headers)
+            resp = conn.getresponse()
+            resp.read()
+        except (OSError, http.client.HTTPException):
+            conn.close()
+            if not reused:
+                raise
+            # The server may have dropped an idle keep-alive connection
+            conn = self._new(*key)
+            try:
+                conn.request('POST', path, body=body, headers=headers)
+                resp = conn.getresponse()
+                resp.read()
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                raise
+        if resp.will_close:
+            conn.close()
+        else:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_idle_per_host:
+                    idle.append(conn)
+                else:
+                    conn.close()
+        return resp.status
+
+    def close(self):
+        with self._lock:
+            for conns in self._idle.values():
+                for conn in conns:
+                    conn.close()
+            self._idle = {}
+
+
+class WebhookDispatcher:
+    """Asynchronous, batched webhook delivery with retries and a dead-letter list"""
+
+    def __init__(self, base, settings):
+        self.base = base
+        self.settings = settings
+        self.pool = ConnectionPool(settings['timeout'])
+        self.stats = {'delivered': 0, 'failed_attempts': 0, 'dead_lettered': 0}
+        self._jobs = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopping = False
+        self._stop_event = threading.Event()
+        self._dead_lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.settings['workers']):
+            t = threading.Thread(target=self._worker, name=f'webhook-worker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._poller, name='webhook-outbox', daemon=True)
+        t.start()
+        self._threads.append(t)
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        self._stop_event.set()
+        self.pool.close()
+
+    def pending(self):
+        with self._cond:
+            return len(self._jobs)
+
+    def submit(self, events):
+        """Match events to subscriptions and queue one delivery per endpoint batch"""
+        per_url = {}
+        for sub in load_subscriptions(self.base):
+            for event in events:
+                if matches(sub, event):
+                    per_url.setdefault(sub['url'], []).append(event)
+        size = max(1, self.settings['batch_size'])
+        for url, url_events in per_url.items():
+            for i in range(0, len(url_events), size):
+                self._schedule({'url': url, 'events': url_events[i:i + size], 'attempt': 0}, 0)
+        return len(per_url)
+
+    def poll_outbox(self):
+        """Submit and remove outbox files written by the fetcher"""
+        for path in sorted(glob.glob(os.path.join(outbox_dir(self.base), '*.json'))):
+            events = _read_json(path, [])
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            if events:
+                self.submit(events)
+
+    def _schedule(self, job, delay):
+        with self._cond:
+            heapq.heappush(self._jobs, (time.monotonic() + delay, next(self._seq), job))
+            self._cond.notify()
+
+    def _poller(self):
+        while not self._stop_event.is_set():
+            try:
+                self.poll_outbox()
+            except Exception as e:
+                print(f"✗ Помилка читання webhook outbox: {e}")
+            self._stop_event.wait(self.settings['poll_interval'])
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    if self._jobs:
+                        due = self._jobs[0][0] - time.monotonic()
+                        if due <= 0:
+                            break
+                        self._cond.wait(due)
+                    else:
+                        self._cond.wait()
+                if self._stopping:
+                    return
+                _, _, job = heapq.heappop(self._jobs)
+            self._deliver(job)
+
+    def _deliver(self, job):
+        delivery_id = uuid.uuid4().hex
+        body = json.dumps({
+            'delivery_id': delivery_id,
+            'sent_at': datetime.datetime.now().isoformat(),
+            'events': job['events'],
+        }, ensure_ascii=False).encode('utf-8')
+        headers = {
+            'Content-Type': 'application/json; charset=utf-8',
+            'X-GPV-Delivery': delivery_id,
+            'X-GPV-Attempt': str(job['attempt'] + 1),
+        }
+        error = None
+        try:
+            # Re-checked on every attempt: DNS may have changed since subscribing
+            check_target(job['url'], self.settings)
+            status = self.pool.post(job['url'], body, headers)
+            if 200 <= status < 300:
+                with self._cond:
+                    self.stats['delivered'] += 1
+                return
+            error = f'HTTP {status}'
+        except (OSError, http.client.HTTPException, ValueError) as e:
+            error = str(e) or e.__class__.__name__
+
+        job['attempt'] += 1
+        job['last_error'] = error
+        with self._cond:
+            self.stats['failed_attempts'] += 1
+        if job['attempt'] > self.settings['max_retries']:
+            self._dead_letter(job)
+            return
+        delay = min(self.settings['backoff_seconds'] * 2 ** (job['attempt'] - 1),
+                    self.settings['max_backoff_seconds'])
+        self._schedule(job, delay * random.uniform(0.8, 1.2))
+
+    def _dead_letter(self, job):
+        with self._dead_lock:
+            dead = load_dead_letters(self.base)
+            dead.append({
+                'url': job['url'],
+                'attempts': job['attempt'],
+                'last_error': job.get('last_error'),
+                'failed_at': datetime.datetime.now().isoformat(),
+                'events': job['events'],
+            })
+            _write_json(dead_letter_path(self.base), dead[-MAX_DEAD_LETTERS:])
+        with self._cond:
+            self.stats['dead_lettered'] += 1
+        print(f"✗ Webhook {job['url']} не доставлено після {job['attempt']} спроб: {job.get('last_error')}")
+
+
+def receive(port):
+    """Tiny HTTP receiver that prints every delivered batch"""
+
+    class Handler(http.server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length) or b'{}')
+            print(f"[{datetime.datetime.now()}] delivery {payload.get('delivery_id')} "
+                  f"attempt {self.headers.get('X-GPV-Attempt')}: {len(payload.get('events', []))} events")
+            for event in payload.get('events', []):
+                print(f"  channel {event['channel_id']} queue {event['queue']} {event['date']}: "
+                      f"{event['previous']} -> {event['schedule']}")
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    print(f'Listening for webhooks on http://127.0.0.1:{port}/')
+    server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Webhook tools')
+    sub = parser.add_subparsers(dest='command', required=True)
+    run = sub.add_parser('receive', help='run a local receiver that prints deliveries')
+    run.add_argument('--port', type=int, default=8099)
+    args = parser.parse_args(argv)
+    receive(args.port)
+
+
+if __name__ == '__main__':
+    main()